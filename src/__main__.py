@@ -10,6 +10,9 @@ from utils import logger, helpers
 
 import state as st
 import database
+import datafetch
+import archive
+import scoredapi
 import ingest
 import webserver
 
@@ -20,6 +23,11 @@ parser.add_argument('--backingest', action='store_true', required=False)
 parser.add_argument('--ingestlogs', action='store', required=False)
 parser.add_argument('--discovermod', action='store', required=False)
 parser.add_argument('-a', '--add', action='store', required=False)
+parser.add_argument('--checkplans', action='store_true', required=False)
+parser.add_argument('--checkgreen', action='store_true', required=False)
+parser.add_argument('--dedupe', action='store_true', required=False)
+parser.add_argument('--migrate', action='store_true', required=False)
+parser.add_argument('--convertdb', action='store_true', required=False)
 
 known, unknown = parser.parse_known_args()
 
@@ -43,6 +51,49 @@ def mode_ingestlogs(communities):
 	for community in communities:
 		helpers.thread('IngestLog-%s' % community, thread_ingestlog, community)
 
+def mode_checkplans():
+	with database.DBRequest() as db:
+		failed = datafetch.check_query_plans(db)
+	if failed:
+		logger.logerr('%d queries fall back to table scans' % len(failed))
+		sys.exit(1)
+	logger.log('Job finished')
+	sys.exit()
+
+def mode_checkgreen():
+	if st.config['database'] != 'postgres':
+		logger.logerr('Green I/O only applies to postgres')
+		sys.exit(1)
+	if not st.config['postgres_green']:
+		database.make_postgres_green()
+	if not database.check_green_postgres():
+		logger.logerr('Postgres queries block other greenlets')
+		sys.exit(1)
+	logger.log('Job finished')
+	sys.exit()
+
+def mode_migrate():
+	#Pending migrations already ran in init_database
+	with database.DBRequest() as db:
+		logger.log('Database is at schema version %d' % database.get_schema_version(db))
+	logger.log('Job finished')
+	sys.exit()
+
+def mode_convertdb():
+	if st.config['database'] != 'postgres':
+		logger.logerr('Set the database to postgres; the archive at sqlite_path is copied into it')
+		sys.exit(1)
+	with database.DBRequest('sqlite') as src, database.DBRequest('postgres') as dst:
+		database.convert_database(src, dst)
+	logger.log('Job finished')
+	sys.exit()
+
+def mode_dedupe():
+	with database.DBRequest() as db:
+		database.merge_duplicate_names(db)
+	logger.log('Job finished')
+	sys.exit()
+
 def mode_add(communities):
 	for name in communities:
 		ingest.discover_community(name)
@@ -58,8 +109,26 @@ def main():
 	logger.start_logger(st.config['log_directory'], st.config['log_level'])
 	logger.log('Starting Unscored server ver. %s' % st.VERSION)
 	database.init_database()
+	archive.init_compression()
+	if st.config['single_writer']:
+		database.start_writer()
 		
 	try:
+		if known.checkplans:
+			mode_checkplans()
+
+		if known.checkgreen:
+			mode_checkgreen()
+
+		if known.migrate:
+			mode_migrate()
+
+		if known.convertdb:
+			mode_convertdb()
+
+		if known.dedupe:
+			mode_dedupe()
+
 		if known.discover:
 			mode_discover()
 		
@@ -75,6 +144,12 @@ def main():
 		if known.backingest:
 			helpers.thread('BackIngest', ingest.thread_backingest)
 
+		if st.config['caching'] and st.config['disk_cache']:
+			helpers.thread('CacheCompactor', scoredapi.thread_compact_cache)
+
+		if st.config['compress_content']:
+			helpers.thread('Recompress', archive.thread_recompress)
+
 		if st.config['ingest_enabled']:
 			freq = st.get_ingest_frequency_stat()
 			logger.log('Average ingests per day: %d (every %s seconds)' % (int(freq), round(24*60*60/freq, 2)))
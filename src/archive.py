@@ -1,4 +1,8 @@
+import re
 import time
+import zlib
+import base64
+import collections
 
 from utils import logger, helpers
 
@@ -23,107 +27,344 @@ MONITORED_MODLOG_ACTIONS = [
 ]
 
 
+###########################
+### Content compression ###
+
+#Compressed bodies live in raw_content_z with raw_content set to NULL. The first byte
+#of a blob is the id of the preset dictionary it was compressed with, 0 meaning none.
+ZDICT_MAX_BYTES = 32 * 1024
+RE_DICT_TOKEN = re.compile(r'\s*\S+')
+
+zdicts = {0: b''}
+currentZdict = 0
+compressionStats = collections.Counter()
+
+def _load_zdict(dict_id: int) -> bytes:
+	with database.DBRequest() as db:
+		value = database.get_meta(db, 'zdict_%d' % dict_id)
+	if value is None:
+		raise ValueError('Unknown compression dictionary %d' % dict_id)
+	zdicts[dict_id] = base64.b64decode(value)
+	return zdicts[dict_id]
+
+#Builds a preset dictionary from the tokens that occur in the most recent bodies
+def train_dictionary(db: database.DBRequest):
+	global currentZdict
+	samples = [
+		row.raw_content
+		for row in db.query(
+			"SELECT raw_content FROM comments WHERE raw_content_z IS NULL AND length(raw_content) >= ? ORDER BY id DESC LIMIT ?",
+			st.config['compress_min_bytes'],
+			st.config['compress_dict_samples']
+		)
+	]
+	if not samples:
+		return
+	counts = collections.Counter()
+	for text in samples:
+		counts.update(set(RE_DICT_TOKEN.findall(text)))
+	parts = []
+	size = 0
+	for token, count in counts.most_common():
+		data = token.encode()
+		if count < 2 or size + len(data) > ZDICT_MAX_BYTES:
+			break
+		parts.append(data)
+		size += len(data)
+	#zlib matches closest to the end of the dictionary most cheaply, so the most common tokens go last
+	zdict = b''.join(reversed(parts))
+	dict_id = max(zdicts) + 1
+	database.set_meta(db, 'zdict_%d' % dict_id, base64.b64encode(zdict).decode())
+	database.set_meta(db, 'zdict_current', dict_id)
+	zdicts[dict_id] = zdict
+	currentZdict = dict_id
+	logger.log('Trained compression dictionary %d (%d bytes from %d samples)' % (dict_id, len(zdict), len(samples)))
+
+def init_compression():
+	global currentZdict
+	with database.DBRequest() as db:
+		currentZdict = int(database.get_meta(db, 'zdict_current', 0))
+		if currentZdict:
+			_load_zdict(currentZdict)
+		elif st.config['compress_content']:
+			train_dictionary(db)
+
+#Returns the (raw_content, raw_content_z) column values to store a body with
+def pack_content(text: str) -> tuple:
+	if not st.config['compress_content'] or text is None:
+		return text, None
+	data = text.encode()
+	if len(data) < st.config['compress_min_bytes']:
+		return text, None
+	tStart = time.perf_counter_ns()
+	zdict = zdicts[currentZdict]
+	compressor = zlib.compressobj(st.config['compress_level'], zdict=zdict) if zdict else zlib.compressobj(st.config['compress_level'])
+	blob = bytes([currentZdict]) + compressor.compress(data) + compressor.flush()
+	compressionStats['compress_ns'] += time.perf_counter_ns() - tStart
+	if len(blob) >= len(data):
+		compressionStats['incompressible'] += 1
+		return text, None
+	compressionStats['compressed'] += 1
+	compressionStats['bytes_in'] += len(data)
+	compressionStats['bytes_out'] += len(blob)
+	return None, blob
+
+def has_raw_content(item) -> bool:
+	return getattr(item, 'raw_content_z', None) is not None or bool(item.raw_content)
+
+#Body of an archived post or comment row, decompressed only when it is stored compressed
+def get_raw_content(item) -> str:
+	blob = getattr(item, 'raw_content_z', None)
+	if blob is None:
+		return item.raw_content
+	blob = bytes(blob)
+	zdict = zdicts[blob[0]] if blob[0] in zdicts else _load_zdict(blob[0])
+	tStart = time.perf_counter_ns()
+	decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+	text = (decompressor.decompress(blob[1:]) + decompressor.flush()).decode()
+	compressionStats['decompress_ns'] += time.perf_counter_ns() - tStart
+	compressionStats['decompressed'] += 1
+	return text
+
+def get_compression_stats() -> dict:
+	stats = dict(compressionStats)
+	stats['ratio'] = round(stats['bytes_out'] / stats['bytes_in'], 3) if stats.get('bytes_in') else None
+	stats['compress_us_avg'] = round(stats.get('compress_ns', 0) / 1000 / max(1, stats.get('compressed', 0) + stats.get('incompressible', 0)), 1)
+	stats['decompress_us_avg'] = round(stats.get('decompress_ns', 0) / 1000 / max(1, stats.get('decompressed', 0)), 1)
+	return stats
+
+
+@database.write_job
+def _store_recompressed(db: database.DBRequest, table: str, updates: list, lastId: int):
+	if updates:
+		db.execmany("UPDATE %s SET raw_content = NULL, raw_content_z = ? WHERE id = ? AND raw_content = ?" % table, updates)
+	database.set_meta(db, 'recompress_%s_id' % table, lastId)
+
+def _recompress_table(db: database.DBRequest, table: str):
+	lastId = int(database.get_meta(db, 'recompress_%s_id' % table, 0))
+	rows = 0
+	bytesIn = bytesOut = 0
+	tStart = time.time()
+	while True:
+		batch = db.query(
+			"SELECT id, raw_content FROM %s WHERE id > ? AND raw_content_z IS NULL AND length(raw_content) >= ? ORDER BY id LIMIT ?" % table,
+			lastId,
+			st.config['compress_min_bytes'],
+			st.config['recompress_batch_size']
+		)
+		if not batch:
+			break
+		updates = []
+		for row in batch:
+			raw_content, blob = pack_content(row.raw_content)
+			if blob is not None:
+				#Only replaces the body if nothing rewrote it in the meantime
+				updates.append((blob, row.id, row.raw_content))
+				bytesIn += len(row.raw_content.encode())
+				bytesOut += len(blob)
+		lastId = batch[-1].id
+		_store_recompressed(db, table, updates, lastId)
+		rows += len(updates)
+		time.sleep(st.config['recompress_cooldown'])
+	if rows:
+		elapsed = max(time.time() - tStart, 0.001)
+		logger.log('Recompressed %d %s in %.1f s (%.0f rows/s), %d -> %d bytes (%.1f%%)' % (
+			rows, table, elapsed, rows / elapsed, bytesIn, bytesOut, 100 * bytesOut / bytesIn
+		))
+
+#Compresses bodies that were archived before compression was enabled, then keeps catching up
+def thread_recompress():
+	while True:
+		with database.DBRequest() as db:
+			for table in ('posts', 'comments'):
+				_recompress_table(db, table)
+		time.sleep(st.config['recompress_interval'])
+
+
+
 ######################
 ### Data ingestion ###
 
-def _add_post(db: database.DBRequest, post: dict):
-	db.commit()
-	board_id = database.get_board_id(db, post['community'])
-	author_id = database.get_author_id(db, post['author'])
-	moderation = post.get('moderation', scoredapi.DEFAULT_MODERATION_INFO)
-	
-	removal_source = post['removal_source'] if post['is_removed'] else None
+POST_COLUMNS = (
+	'id',
+	'board_id',
+	'author_id',
+	'type',
+	'link',
+	'preview',
+	'title',
+	'raw_content',
+	'raw_content_z',
+	'created_ms',
+	'known_deleted',
+	'removal_source',
+	'archived_at_ms',
+	'removed_at_ms',
+	'removed_by',
+	'approved_at_ms',
+	'approved_by'
+)
+
+COMMENT_COLUMNS = (
+	'id',
+	'board_id',
+	'author_id',
+	'post_id',
+	'comment_parent_id',
+	'raw_content',
+	'raw_content_z',
+	'created_ms',
+	'archived_at_ms',
+	'known_deleted',
+	'removal_source',
+	'removed_at_ms',
+	'removed_by',
+	'approved_at_ms',
+	'approved_by'
+)
+
+def _insert_statement(table: str, columns: tuple):
+	return "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (id) DO NOTHING" % (table, ', '.join(columns), ', '.join('?' * len(columns)))
+
+INSERT_POST = _insert_statement('posts', POST_COLUMNS)
+INSERT_COMMENT = _insert_statement('comments', COMMENT_COLUMNS)
+
+#Rows per multi-row INSERT, keeping the bound parameters below SQLite's default limit of 999
+INSERT_ROWS_PER_QUERY = 50
+
+def _insert_rows(db: database.DBRequest, table: str, columns: tuple, rows: list) -> int:
+	#RETURNING only yields the rows that were inserted, not those skipped by ON CONFLICT
+	added = 0
+	for i in range(0, len(rows), INSERT_ROWS_PER_QUERY):
+		chunk = rows[i:i + INSERT_ROWS_PER_QUERY]
+		placeholders = ', '.join(['(%s)' % ', '.join('?' * len(columns))] * len(chunk))
+		q = "INSERT INTO %s (%s) VALUES %s ON CONFLICT (id) DO NOTHING RETURNING id" % (table, ', '.join(columns), placeholders)
+		added += len(db.query(q, *[value for row in chunk for value in row]))
+	return added
+
+
+def _new_removal_source(item: dict):
+	removal_source = item['removal_source'] if item['is_removed'] else None
 	if removal_source and removal_source.endswith('Pending'):
 		removal_source = removal_source[:-7]
 	if removal_source == 'deleted':
 		removal_source = 'unknown'
+	return removal_source
 
-	IntegrityError = db.get_IntegrityError()
-	try:
-		db.exec(
-			"""
-			INSERT INTO posts (
-				id,
-				board_id,
-				author_id,
-				type,
-				link,
-				preview,
-				title,
-				raw_content,
-				created_ms,
-				known_deleted,
-				removal_source,
-				archived_at_ms,
-				removed_at_ms,
-				removed_by,
-				approved_at_ms,
-				approved_by
-			) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-			""",
-			post['id'],
-			board_id,
-			author_id,
-			post['type'],
-			post['link'],
-			post['preview'],
-			post['title'],
-			post['raw_content'].replace('\r\n', '\n'),
-			post['created'],
-			post['is_deleted'],
-			removal_source,
-			time.time_ns() // 10**6,
-			moderation['removed_at'] if moderation['removed_at'] else None,
-			moderation['removed_by'] if moderation['removed_by'] else None,
-			moderation['approved_at'] if moderation['approved_at'] else None,
-			moderation['approved_by'] if moderation['approved_by'] else None
-		)
-	except IntegrityError:
+def _post_row(post: dict, board_id: int, author_id: int):
+	moderation = post.get('moderation', scoredapi.DEFAULT_MODERATION_INFO)
+	return (
+		post['id'],
+		board_id,
+		author_id,
+		post['type'],
+		post['link'],
+		post['preview'],
+		post['title'],
+		*pack_content(post['raw_content'].replace('\r\n', '\n')),
+		post['created'],
+		post['is_deleted'],
+		_new_removal_source(post),
+		time.time_ns() // 10**6,
+		moderation['removed_at'] if moderation['removed_at'] else None,
+		moderation['removed_by'] if moderation['removed_by'] else None,
+		moderation['approved_at'] if moderation['approved_at'] else None,
+		moderation['approved_by'] if moderation['approved_by'] else None
+	)
+
+def _comment_row(comment: dict, board_id: int, author_id: int):
+	moderation = comment.get('moderation', scoredapi.DEFAULT_MODERATION_INFO)
+	return (
+		comment['id'],
+		board_id,
+		author_id,
+		comment['parent_id'],
+		comment['comment_parent_id'],
+		*pack_content(comment['raw_content'].replace('\r\n', '\n')),
+		comment['created'],
+		time.time_ns() // 10**6,
+		comment['is_deleted'],
+		_new_removal_source(comment),
+		moderation['removed_at'] if moderation['removed_at'] else None,
+		moderation['removed_by'] if moderation['removed_by'] else None,
+		moderation['approved_at'] if moderation['approved_at'] else None,
+		moderation['approved_by'] if moderation['approved_by'] else None
+	)
+
+
+def _add_post(db: database.DBRequest, post: dict):
+	db.commit()
+	board_id = database.get_board_id(db, post['community'])
+	author_id = database.get_author_id(db, post['author'])
+	db.exec(INSERT_POST, *_post_row(post, board_id, author_id))
+	if not db.rowcount:
 		logger.logwrn('Post %d already in database' % post['id'])
-		db.rollback()
-	else:
-		db.commit()
+	db.commit()
+
+
+updateCounts = collections.Counter()
 
+def get_update_stats() -> list:
+	#Fields of archived items rewritten since startup, most frequently changed first
+	return updateCounts.most_common()
 
-def update_existing_post(db: database.DBRequest, post: dict, existing_post):
-	removal_source = post['removal_source'] if post['is_removed'] else None
+MODERATION_FIELDS = (
+	('removed_by', 'removed_at_ms', 'removed_at'),
+	('approved_by', 'approved_at_ms', 'approved_at')
+)
+
+def _diff_common(item: dict, existing) -> dict:
+	changes = {}
+	removal_source = item['removal_source'] if item['is_removed'] else None
 	if removal_source and removal_source.endswith('Pending'):
 		removal_source = removal_source[:-7]
-	if removal_source != 'deleted' and removal_source != existing_post.removal_source:
-		db.exec("UPDATE posts SET removal_source = ? WHERE id = ?", removal_source, post['id'])
-		logger.logdebug("Updated removal_source of post %d to %s" % (post['id'], removal_source))
-	if not post['is_removed'] and existing_post.removal_source:
-		db.exec("UPDATE posts SET removal_source = NULL WHERE id = ?", post['id'])
-		logger.logdebug("Removed removal_source from post %d" % post['id'])
-	
-	if 'moderation' in post:
-		m = post['moderation']
-		if existing_post.removed_by is None and m['removed_by']:
-			db.exec("UPDATE posts SET removed_by = ?, removed_at_ms = ? WHERE id = ?", m['removed_by'], m['removed_at'], post['id'])
-			logger.logdebug("Added removed_by to post %d" % post['id'])
-		if existing_post.removed_by != m['removed_by'] and m['removed_by'] != 'Nuked':
-			db.exec("UPDATE posts SET removed_by = ?, removed_at_ms = ? WHERE id = ?", m['removed_by'], m['removed_at'], post['id'])
-			logger.logdebug("Updated removed_by of post %d" % post['id'])
-		if existing_post.approved_by is None and m['approved_by']:
-			db.exec("UPDATE posts SET approved_by = ?, approved_at_ms = ? WHERE id = ?", m['approved_by'], m['approved_at'], post['id'])
-			logger.logdebug("Added approved_by to post %d" % post['id'])
-		if existing_post.approved_by != m['approved_by'] and m['approved_by'] != 'Nuked':
-			db.exec("UPDATE posts SET approved_by = ?, approved_at_ms = ? WHERE id = ?", m['approved_by'], m['approved_at'], post['id'])
-			logger.logdebug("Updated approved_by of post %d" % post['id'])
-
-	if post['raw_content'] and not existing_post.raw_content:
-		db.exec("UPDATE posts SET raw_content = ? WHERE id = ?", post['raw_content'], post['id'])
-		logger.logdebug("Added missing raw_content to post %d" % post['id'])
-	
+	if removal_source != 'deleted' and removal_source != existing.removal_source:
+		changes['removal_source'] = removal_source
+	if not item['is_removed'] and existing.removal_source:
+		changes['removal_source'] = None
+
+	if 'moderation' in item:
+		m = item['moderation']
+		for byField, atField, remoteAtField in MODERATION_FIELDS:
+			existingBy = getattr(existing, byField)
+			if (existingBy is None and m[byField]) or (existingBy != m[byField] and m[byField] != 'Nuked'):
+				changes[byField] = m[byField]
+				changes[atField] = m[remoteAtField]
+
+	if item['raw_content'] and not has_raw_content(existing):
+		changes['raw_content'], changes['raw_content_z'] = pack_content(item['raw_content'])
+	return changes
+
+def _changed_fields(existing, changes: dict) -> dict:
+	return {field: value for field, value in changes.items() if getattr(existing, field) != value}
+
+#Only submitted when something changed, so merging unchanged items never waits for the writer
+@database.write_job
+def _write_changes(db: database.DBRequest, table: str, id: int, changes: dict):
+	db.exec(
+		"UPDATE %s SET %s WHERE id = ?" % (table, ', '.join('%s = ?' % field for field in changes)),
+		*changes.values(),
+		id
+	)
+	for field in changes:
+		updateCounts[table + '.' + field] += 1
+	logger.logdebug('Updated %s of %s %d' % (', '.join(changes), table[:-1], id))
+
+
+#Writes the fields of an archived post that changed in a single UPDATE. Returns the changed fields
+def update_existing_post(db: database.DBRequest, post: dict, existing_post) -> dict:
+	changes = _diff_common(post, existing_post)
 	if post['title'] and not existing_post.title:
-		db.exec("UPDATE posts SET title = ? WHERE id = ?", post['title'], post['id'])
-		logger.logdebug("Added missing title to post %d" % post['id'])
-
+		changes['title'] = post['title']
 	if post['link'] and not existing_post.link:
-		db.exec("UPDATE posts SET link = ? WHERE id = ?", post['link'], post['id'])
-		logger.logdebug("Added missing link to post %d" % post['id'])
+		changes['link'] = post['link']
+	changes = _changed_fields(existing_post, changes)
+	if changes:
+		_write_changes(db, 'posts', post['id'], changes)
+	return changes
 
 
+@database.write_job
 def add_post(db: database.DBRequest, post: dict):
 	community = post['community']
 	existing = db.queryrow("SELECT * FROM posts WHERE id = ?", post['id'])
@@ -140,92 +381,24 @@ def _add_comment(db: database.DBRequest, comment: dict):
 	db.commit()
 	board_id = database.get_board_id(db, comment['community'])
 	author_id = database.get_author_id(db, comment['author'])
-	moderation = comment.get('moderation', scoredapi.DEFAULT_MODERATION_INFO)
-
-	removal_source = comment['removal_source'] if comment['is_removed'] else None
-	if removal_source and removal_source.endswith('Pending'):
-		removal_source = removal_source[:-7]
-	if removal_source == 'deleted':
-		removal_source = 'unknown'
-
-	IntegrityError = db.get_IntegrityError()
-	try:
-		db.exec(
-			"""
-			INSERT INTO comments (
-				id,
-				board_id,
-				author_id,
-				post_id,
-				comment_parent_id,
-				raw_content,
-				created_ms,
-				archived_at_ms,
-				known_deleted,
-				removal_source,
-				removed_at_ms,
-				removed_by,
-				approved_at_ms,
-				approved_by
-			) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-			""",
-			comment['id'],
-			board_id,
-			author_id,
-			comment['parent_id'],
-			comment['comment_parent_id'],
-			comment['raw_content'].replace('\r\n', '\n'),
-			comment['created'],
-			time.time_ns() // 10**6,
-			comment['is_deleted'],
-			removal_source,
-			moderation['removed_at'] if moderation['removed_at'] else None,
-			moderation['removed_by'] if moderation['removed_by'] else None,
-			moderation['approved_at'] if moderation['approved_at'] else None,
-			moderation['approved_by'] if moderation['approved_by'] else None
-		)
-	except IntegrityError:
+	db.exec(INSERT_COMMENT, *_comment_row(comment, board_id, author_id))
+	if not db.rowcount:
 		logger.logwrn('Comment %d already in database' % comment['id'])
-		db.rollback()
-	else:
-		db.commit()
-
+	db.commit()
 
-def update_existing_comment(db: database.DBRequest, comment: dict, existing_comment):
-	removal_source = comment['removal_source'] if comment['is_removed'] else None
-	if removal_source and removal_source.endswith('Pending'):
-		removal_source = removal_source[:-7]
-	if removal_source != 'deleted' and removal_source != existing_comment.removal_source:
-		db.exec("UPDATE comments SET removal_source = ? WHERE id = ?", removal_source, comment['id'])
-		logger.logdebug("Updated removal_source of comment %d to %s" % (comment['id'], removal_source))
-	if not comment['is_removed'] and existing_comment.removal_source:
-		db.exec("UPDATE comments SET removal_source = NULL WHERE id = ?", comment['id'])
-		logger.logdebug("Removed removal_source from comment %d" % comment['id'])
-	
-	if 'moderation' in comment:
-		m = comment['moderation']
-		if existing_comment.removed_by is None and m['removed_by']:
-			db.exec("UPDATE comments SET removed_by = ?, removed_at_ms = ? WHERE id = ?", m['removed_by'], m['removed_at'], comment['id'])
-			logger.logdebug("Added removed_by to comment %d" % comment['id'])
-		if existing_comment.removed_by != m['removed_by'] and m['removed_by'] != 'Nuked':
-			db.exec("UPDATE comments SET removed_by = ?, removed_at_ms = ? WHERE id = ?", m['removed_by'], m['removed_at'], comment['id'])
-			logger.logdebug("Updated removed_by of comment %d" % comment['id'])
-		if existing_comment.approved_by is None and m['approved_by']:
-			db.exec("UPDATE comments SET approved_by = ?, approved_at_ms = ? WHERE id = ?", m['approved_by'], m['approved_at'], comment['id'])
-			logger.logdebug("Added approved_by to comment %d" % comment['id'])
-		if existing_comment.approved_by != m['approved_by'] and m['approved_by'] != 'Nuked':
-			db.exec("UPDATE comments SET approved_by = ?, approved_at_ms = ? WHERE id = ?", m['approved_by'], m['approved_at'], comment['id'])
-			logger.logdebug("Updated approved_by of comment %d" % comment['id'])
-
-	if comment['raw_content'] and not existing_comment.raw_content:
-		db.exec("UPDATE comments SET raw_content = ? WHERE id = ?", comment['raw_content'], comment['id'])
-		logger.logdebug("Added missing raw_content to comment %d" % comment['id'])
 
+#Writes the fields of an archived comment that changed in a single UPDATE. Returns the changed fields
+def update_existing_comment(db: database.DBRequest, comment: dict, existing_comment) -> dict:
+	changes = _diff_common(comment, existing_comment)
 	if comment['comment_parent_id'] != existing_comment.comment_parent_id:
-		db.exec("UPDATE comments SET comment_parent_id = ? WHERE id = ?", comment['comment_parent_id'], comment['id'])
-		logger.logdebug("Updated comment_parent_id of comment %d" % comment['id'])
+		changes['comment_parent_id'] = comment['comment_parent_id']
+	changes = _changed_fields(existing_comment, changes)
+	if changes:
+		_write_changes(db, 'comments', comment['id'], changes)
+	return changes
 
 
+@database.write_job
 def add_comment(db: database.DBRequest, comment: dict):
 	community = comment['community']
 	existing = db.queryrow("SELECT * FROM comments WHERE id = ?", comment['id'])
@@ -235,6 +408,70 @@ def add_comment(db: database.DBRequest, comment: dict):
 	else:
 		logger.logdebug('Adding comment: %s %d' % (community, comment['id']))
 		_add_comment(db, comment)
+
+
+
+def _is_well_formed(item) -> bool:
+	return (
+		isinstance(item, dict) and
+		isinstance(item.get('id'), int) and
+		isinstance(item.get('community'), str) and
+		isinstance(item.get('author'), str)
+	)
+
+def _add_items(db: database.DBRequest, table: str, items: list, columns: tuple, make_row, update_existing):
+	uniqueItems = {}
+	for item in items:
+		if not _is_well_formed(item):
+			logger.logerr('Skipping malformed item %s in %s page' % (item.get('id', 0) if isinstance(item, dict) else repr(item), table))
+			continue
+		uniqueItems.setdefault(item['id'], item)
+	if not uniqueItems:
+		return 0
+	db.commit()
+	try:
+		ids = list(uniqueItems.keys())
+		existing = {
+			row.id: row
+			for row in db.query("SELECT * FROM %s WHERE id IN (%s)" % (table, ', '.join('?' * len(ids))), *ids)
+		}
+		newItems = [item for item in uniqueItems.values() if item['id'] not in existing]
+		boardIds = database.get_board_ids(db, [item['community'] for item in newItems])
+		authorIds = database.get_author_ids(db, [item['author'] for item in newItems])
+		rows = []
+		for item in newItems:
+			try:
+				rows.append(make_row(item, boardIds[item['community'].lower()], authorIds[item['author'].lower()]))
+			except Exception:
+				logger.logerr('Skipping malformed item %d in %s page' % (item['id'], table))
+				logger.log_traceback()
+		added = _insert_rows(db, table, columns, rows)
+		for id, row in existing.items():
+			#A failed update only loses that update, not the rest of the page
+			db.exec("SAVEPOINT update_item")
+			try:
+				update_existing(db, uniqueItems[id], row)
+			except Exception:
+				db.exec("ROLLBACK TO SAVEPOINT update_item")
+				logger.logerr('Failed to update archived item %d in %s page' % (id, table))
+				logger.log_traceback()
+			db.exec("RELEASE SAVEPOINT update_item")
+	except Exception:
+		db.rollback()
+		raise
+	db.commit()
+	logger.logdebug('Archived page of %d %s (%d new)' % (len(uniqueItems), table, added))
+	return added
+
+#Archives a page of posts in a single transaction. Returns the number of newly added posts
+@database.write_job
+def add_posts(db: database.DBRequest, posts: list):
+	return _add_items(db, 'posts', posts, POST_COLUMNS, _post_row, update_existing_post)
+
+#Archives a page of comments in a single transaction. Returns the number of newly added comments
+@database.write_job
+def add_comments(db: database.DBRequest, comments: list):
+	return _add_items(db, 'comments', comments, COMMENT_COLUMNS, _comment_row, update_existing_comment)
 	
 
 
@@ -293,8 +530,43 @@ def _add_ban_record(db: database.DBRequest, timestamp_ms: int, board_id: int,
 			board_id,
 			target_id
 		)
+	database.refresh_ban_status(db, board_id, target_id)
+
+
+moderatorRosters = {}
+
+#Returns the moderators seen in a board's mod log as a dict of id to name
+def get_moderator_roster(db: database.DBRequest, board_id: int) -> dict:
+	roster = moderatorRosters.get(board_id)
+	if roster is None:
+		roster = {
+			row.moderator_id: row.name
+			for row in db.query("SELECT moderator_id, name FROM board_moderators WHERE board_id = ?", board_id)
+		}
+		moderatorRosters[board_id] = roster
+	return roster
+
+def _publish_roster_entry(board_id: int, moderator_id: int, name: str):
+	#Rosters not loaded yet will read the committed row when they are
+	roster = moderatorRosters.get(board_id)
+	if roster is not None:
+		roster.setdefault(moderator_id, name)
+
+def _add_to_moderator_roster(db: database.DBRequest, board_id: int, moderator_id: int, name: str):
+	#Loading the roster here could read rows of a transaction that still rolls back
+	roster = moderatorRosters.get(board_id)
+	if roster is None or moderator_id not in roster:
+		db.exec(
+			"INSERT INTO board_moderators (board_id, moderator_id, name) VALUES (?, ?, ?) ON CONFLICT (board_id, moderator_id) DO NOTHING",
+			board_id,
+			moderator_id,
+			name
+		)
+		db.after_commit(_publish_roster_entry, board_id, moderator_id, name)
+		logger.logdebug('Added %s to moderator roster of board %d' % (repr(name), board_id))
 
 
+@database.write_job
 def add_modlog_record(db: database.DBRequest, community: str, record: dict):
 	logger.logdebug('Adding mod log record: %s, type=%s, created_ms=%d' % (community, record['type'], record['created']))
 	board_id = database.get_board_id(db, community)
@@ -335,6 +607,7 @@ def add_modlog_record(db: database.DBRequest, community: str, record: dict):
 		db.rollback()
 		return
 	else:
+		_add_to_moderator_roster(db, board_id, moderator_id, moderator)
 		db.commit()
 
 	if record['type'] in ('ban', 'unban'):
@@ -360,6 +633,7 @@ def add_modlog_record(db: database.DBRequest, community: str, record: dict):
 		db.exec("UPDATE comments SET raw_content = ?, recovery_method = 'log' WHERE id = ? AND raw_content = ''", description, comment_id)
 
 
+@database.write_job
 def mark_user_suspended(db: database.DBRequest, username):
 	user_id = database.get_author_id(db, username)
 	db.exec("UPDATE authors SET is_suspended = TRUE WHERE id = ? AND NOT is_suspended", user_id)
@@ -368,6 +642,7 @@ def mark_user_suspended(db: database.DBRequest, username):
 	if db.rowcount:
 		logger.log('Marked user %s as suspended' % username)
 
+@database.write_job
 def mark_user_deleted(db: database.DBRequest, username):
 	user_id = database.get_author_id(db, username)
 	db.exec("UPDATE authors SET is_deleted = TRUE WHERE id = ? AND NOT is_deleted", user_id)
@@ -377,13 +652,32 @@ def mark_user_deleted(db: database.DBRequest, username):
 		logger.log('Marked user %s as deleted' % username)
 		if st.config['purge_deleted']:
 			logger.log('Purging content by deleted user %s from database' % username)
-			db.exec("UPDATE posts SET title = '', link = '', raw_content = '' WHERE author_id = ?", user_id)
+			db.exec("UPDATE posts SET title = '', link = '', raw_content = '', raw_content_z = NULL WHERE author_id = ?", user_id)
 			logger.log('%d posts purged' % db.rowcount)
-			db.exec("UPDATE comments SET raw_content = '' WHERE author_id = ?", user_id)
+			db.exec("UPDATE comments SET raw_content = '', raw_content_z = NULL WHERE author_id = ?", user_id)
 			logger.log('%d comments purged' % db.rowcount)
 
 
 
+@database.write_job
+def set_recovery_method(db: database.DBRequest, post_id: int, method: str):
+	db.exec("UPDATE posts SET recovery_method = ? WHERE id = ?", method, post_id)
+
+@database.write_job
+def mark_post_deleted(db: database.DBRequest, post_id: int):
+	db.exec("UPDATE posts SET known_deleted = TRUE WHERE id = ?", post_id)
+
+@database.write_job
+def purge_post(db: database.DBRequest, post_id: int):
+	db.exec("UPDATE posts SET raw_content = '', raw_content_z = NULL, link = '', preview = '' WHERE id = ?", post_id)
+
+@database.write_job
+def purge_comment(db: database.DBRequest, comment_id: int):
+	db.exec("UPDATE comments SET raw_content = '', raw_content_z = NULL WHERE id = ?", comment_id)
+
+
+
+@database.write_job
 def process_removal_request(db: database.DBRequest, ip: str, content_type: str, content_id: int, reason: str, description: str):
 	if content_type == 'post':
 		item = db.queryrow("SELECT * FROM posts WHERE id = ?", content_id)
@@ -411,6 +705,7 @@ def process_removal_request(db: database.DBRequest, ip: str, content_type: str,
 			'error': 'Not reportable'
 		}
 
+@database.write_job
 def approve_item(db: database.DBRequest, content_type: str, content_id: int):
 	if content_type == 'post':
 		db.exec("UPDATE posts SET legal_removed = FALSE, legal_approved = TRUE WHERE id = ?", content_id)
@@ -420,6 +715,7 @@ def approve_item(db: database.DBRequest, content_type: str, content_id: int):
 		db.exec("UPDATE removal_requests SET cleared = TRUE WHERE comment_id = ?", content_id)
 	logger.log('Approved archived content: %s %d' % (content_type, content_id))
 
+@database.write_job
 def remove_item(db: database.DBRequest, content_type: str, content_id: int):
 	if content_type == 'post':
 		db.exec("UPDATE posts SET legal_removed = TRUE, legal_approved = FALSE WHERE id = ?", content_id)
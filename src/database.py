@@ -1,55 +1,476 @@
+import io
+import os
 import re
+import zlib
+import base64
+import bisect
+import inspect
 import time
+import queue
 import sqlite3
+import functools
 import contextlib
+import threading
 from collections import namedtuple
 
 with contextlib.suppress(ImportError):
 	import psycopg2
 	import psycopg2.extras
+	import psycopg2.extensions
 
 from utils import logger
+from utils.cache import LRUCache
 
 import state as st
 
-def sqlite3_namedtuple_factory(cursor, row):
-	fields = [column[0] for column in cursor.description]
-	cls = namedtuple("Row", fields)
-	return cls._make(row)
+#################
+### Row types ###
 
+rowClasses = {}
 
+#Returns the namedtuple class for a set of result columns, creating it only once
+def get_row_class(fields: tuple):
+	cls = rowClasses.get(fields)
+	if cls is None:
+		cls = namedtuple("Row", fields, rename=True)
+		rowClasses[fields] = cls
+	return cls
 
-class DBRequest:
-	rowcount = 0
-	statusmessage = None
-	def __init__(self, dbType=None):
-		if dbType:
-			self.dbType = dbType
+def make_row(description, row):
+	if row is None or not description:
+		return row
+	return get_row_class(tuple(column[0] for column in description))._make(row)
+
+def make_rows(description, rows):
+	if not description:
+		return rows
+	make = get_row_class(tuple(column[0] for column in description))._make
+	return [make(row) for row in rows]
+
+
+
+#########################
+### Query translation ###
+
+RE_AUTOINCREMENT = re.compile(re.escape('integer PRIMARY KEY AUTOINCREMENT'), flags=re.IGNORECASE)
+RE_GROUP_CONCAT = re.compile(re.escape('group_concat'), flags=re.IGNORECASE)
+RE_LIKE = re.compile(r'(\s)(LIKE)(\s)', flags=re.IGNORECASE)
+
+MAX_TRANSLATED_QUERIES = 5000
+
+translatedQueries = {}
+translationStats = {
+	'hits': 0,
+	'misses': 0
+}
+
+def _translate_postgres(query):
+	query = query.replace('?', '%s')
+	query = RE_AUTOINCREMENT.sub('bigserial PRIMARY KEY', query)
+	query = RE_GROUP_CONCAT.sub('string_agg', query)
+	query = RE_LIKE.sub(r'\1I\2\3', query)
+	return query
+
+#Converts a query written for SQLite to the given dialect. Each distinct query is only translated once
+def translate_query(dbType, query):
+	if dbType != 'postgres':
+		return query
+	key = (dbType, query)
+	translated = translatedQueries.get(key)
+	if translated is not None:
+		translationStats['hits'] += 1
+		return translated
+	translationStats['misses'] += 1
+	translated = _translate_postgres(query)
+	if len(translatedQueries) < MAX_TRANSLATED_QUERIES:
+		translatedQueries[key] = translated
+	return translated
+
+def get_translation_stats():
+	stats = translationStats.copy()
+	stats['cached'] = len(translatedQueries)
+	stats['row_classes'] = len(rowClasses)
+	return stats
+
+
+
+########################
+### Query statistics ###
+
+RE_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+RE_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+RE_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+RE_VALUES_LIST = re.compile(r'\((?:\?\s*,\s*)*\?\)(?:\s*,\s*\((?:\?\s*,\s*)*\?\))+')
+RE_WHITESPACE = re.compile(r'\s+')
+
+#Upper bounds in ms; the last bucket catches everything slower
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf')]
+MAX_FINGERPRINTS = 2000
+
+fingerprints = {}
+queryStats = {}
+queryStatsLock = threading.Lock()
+
+#Normalizes a query by stripping literals and collapsing placeholder lists, so its variants share one entry
+def fingerprint_query(query):
+	fingerprint = fingerprints.get(query)
+	if fingerprint is not None:
+		return fingerprint
+	fingerprint = RE_STRING_LITERAL.sub('?', query)
+	fingerprint = RE_NUMBER_LITERAL.sub('?', fingerprint)
+	fingerprint = RE_VALUES_LIST.sub('(?)...', fingerprint)
+	fingerprint = RE_PLACEHOLDER_LIST.sub('?...', fingerprint)
+	fingerprint = RE_WHITESPACE.sub(' ', fingerprint).strip()
+	if len(fingerprints) < MAX_TRANSLATED_QUERIES:
+		fingerprints[query] = fingerprint
+	return fingerprint
+
+def _find_caller():
+	frame = inspect.currentframe()
+	while frame and frame.f_code.co_filename == __file__:
+		frame = frame.f_back
+	if frame is None:
+		return '?'
+	return '%s:%d %s()' % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+
+def record_query(query, ms):
+	fingerprint = fingerprint_query(query)
+	with queryStatsLock:
+		stats = queryStats.get(fingerprint)
+		if stats is None:
+			if len(queryStats) >= MAX_FINGERPRINTS:
+				fingerprint = '(other)'
+				stats = queryStats.get(fingerprint)
+			if stats is None:
+				stats = queryStats[fingerprint] = {
+					'count': 0,
+					'total_ms': 0.0,
+					'max_ms': 0.0,
+					'buckets': [0] * len(LATENCY_BUCKETS)
+				}
+		stats['count'] += 1
+		stats['total_ms'] += ms
+		stats['max_ms'] = max(stats['max_ms'], ms)
+		stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+	if ms >= st.config['slow_query_ms']:
+		logger.logwrn('Slow query (%d ms) from %s: %s' % (ms, _find_caller(), fingerprint))
+
+#Upper bound of the bucket holding the given fraction of calls, capped at the slowest call seen
+def _percentile(stats, fraction):
+	target = stats['count'] * fraction
+	seen = 0
+	for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+		seen += count
+		if seen >= target:
+			return min(bound, round(stats['max_ms'], 1))
+	return round(stats['max_ms'], 1)
+
+#Per-statement latency summary, sorted by total time spent
+def get_query_stats(limit=50):
+	with queryStatsLock:
+		items = [(fingerprint, dict(stats, buckets=list(stats['buckets']))) for fingerprint, stats in queryStats.items()]
+	summary = []
+	for fingerprint, stats in items:
+		summary.append({
+			'query': fingerprint,
+			'count': stats['count'],
+			'total_ms': round(stats['total_ms'], 1),
+			'mean_ms': round(stats['total_ms'] / stats['count'], 2),
+			'p50_ms': _percentile(stats, 0.50),
+			'p95_ms': _percentile(stats, 0.95),
+			'p99_ms': _percentile(stats, 0.99),
+			'max_ms': round(stats['max_ms'], 1)
+		})
+	summary.sort(key=lambda q: q['total_ms'], reverse=True)
+	return summary[:limit]
+
+def reset_query_stats():
+	with queryStatsLock:
+		queryStats.clear()
+
+
+
+########################
+### Green Postgres I/O ###
+
+def _eventlet_wait_callback(con, timeout=-1):
+	from eventlet.hubs import trampoline
+	while True:
+		state = con.poll()
+		if state == psycopg2.extensions.POLL_OK:
+			break
+		elif state == psycopg2.extensions.POLL_READ:
+			trampoline(con.fileno(), read=True)
+		elif state == psycopg2.extensions.POLL_WRITE:
+			trampoline(con.fileno(), write=True)
 		else:
-			self.dbType = st.config['database']
+			raise psycopg2.OperationalError('Bad result from poll: %r' % state)
+
+#Opt-in through postgres_green, which is off by default: the wait callback has only been
+#exercised against a stubbed connection, never a live server. Run --checkgreen first.
+#Makes psycopg2 wait for the server through the eventlet hub, so other greenlets keep running during a query
+def make_postgres_green():
+	psycopg2.extensions.set_wait_callback(_eventlet_wait_callback)
+	logger.logdebug('Registered eventlet wait callback for psycopg2')
+
+def make_postgres_blocking():
+	psycopg2.extensions.set_wait_callback(None)
+
+#Runs pg_sleep in one greenlet while another ticks every 100 ms; True if the ticker kept running
+def check_green_postgres(seconds=2) -> bool:
+	import eventlet
+	ticks = []
+	def ticker():
+		while True:
+			ticks.append(time.monotonic())
+			eventlet.sleep(0.1)
+	def sleeper():
+		with DBRequest('postgres') as db:
+			db.exec("SELECT pg_sleep(?)", seconds)
+	tickerThread = eventlet.spawn(ticker)
+	tStart = time.monotonic()
+	eventlet.spawn(sleeper).wait()
+	elapsed = time.monotonic() - tStart
+	tickerThread.kill()
+	expected = int(seconds / 0.1)
+	logger.log('pg_sleep(%d) took %.2f s, other greenlet ticked %d of %d times' % (seconds, elapsed, len(ticks), expected))
+	return len(ticks) >= expected // 2
+
+
+
+######################
+### SQLite profile ###
+
+SQLITE_PRAGMAS = ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store')
+
+#Applies the pragmas of the sqlite_profile config section to a new connection
+def apply_sqlite_profile(con, profile: dict):
+	for pragma in SQLITE_PRAGMAS:
+		if pragma not in profile or profile[pragma] is None:
+			continue
+		value = str(profile[pragma])
+		if not re.match(r'^-?[A-Za-z0-9_]+$', value):
+			raise ValueError('Invalid value for sqlite_profile.%s: %s' % (pragma, value))
+		con.execute("PRAGMA %s = %s" % (pragma, value)).fetchall()
+	for pragma in profile:
+		if pragma not in SQLITE_PRAGMAS:
+			logger.logwrn('Ignoring unsupported sqlite_profile setting: %s' % pragma)
+
+
+
+#########################
+### SQLite thread pool ###
+
+tpool = None
+
+def use_sqlite_threadpool():
+	return tpool is not None and st.config['sqlite_threadpool']
+
+#Runs a blocking SQLite call outside of a DBRequest, on the thread pool when it is in use
+def run_sqlite(func, *args):
+	if use_sqlite_threadpool():
+		return tpool.execute(func, *args)
+	return func(*args)
+
+#Runs SQLite calls on eventlet's OS thread pool. Only has an effect once eventlet has patched threading
+def start_sqlite_threadpool():
+	global tpool
+	try:
+		import eventlet.patcher
+		import eventlet.tpool
+	except ImportError:
+		return
+	if not eventlet.patcher.is_monkey_patched('thread'):
+		return
+	eventlet.tpool.set_num_threads(st.config['sqlite_threadpool_size'])
+	tpool = eventlet.tpool
+	logger.logdebug('Running SQLite queries on %d worker threads' % st.config['sqlite_threadpool_size'])
+
+
+
+######################
+### Connection pool ###
+
+class PoolTimeout(Exception): pass
+
+
+HEALTHCHECK_AFTER = 30
+
+#Keeps up to `size` idle connections open for reuse and opens at most `max_size` in total.
+#Checkouts beyond `size` open extra connections, which are closed again on checkin;
+#at `max_size` checkouts wait up to `checkout_timeout` seconds for one to be returned.
+class ConnectionPool:
+	def __init__(self, dbType, size, max_size, idle_timeout, checkout_timeout):
+		self.dbType = dbType
+		self.size = size
+		self.maxSize = max(size, max_size)
+		self.idleTimeout = idle_timeout
+		self.checkoutTimeout = checkout_timeout
+		self.idle = []
+		self.inUse = 0
+		self.lock = threading.Condition()
+		self.stats = {
+			'created': 0,
+			'reused': 0,
+			'discarded': 0,
+			'evicted': 0,
+			'checkouts': 0,
+			'overflow': 0,
+			'waits': 0,
+			'timeouts': 0,
+			'peak_in_use': 0,
+			'checkout_ms_total': 0,
+			'checkout_ms_max': 0
+		}
+
+	def _connect(self):
 		tStart = time.time_ns()
 		if self.dbType == 'postgres':
-			self.con = psycopg2.connect(
+			con = psycopg2.connect(
 				dbname = st.config['postgres_dbname'],
 				host = st.config['postgres_host'],
 				port = st.config['postgres_port'],
 				user = st.config['postgres_user'],
-				password = st.config['postgres_password'],
-				cursor_factory = psycopg2.extras.NamedTupleCursor
+				password = st.config['postgres_password']
 			)
 		else:
-			self.con = sqlite3.connect(st.config['sqlite_path'])
-			self.con.row_factory = sqlite3_namedtuple_factory
+			con = sqlite3.connect(st.config['sqlite_path'], check_same_thread=False)
+			apply_sqlite_profile(con, st.config.get('sqlite_profile', {}))
 		ms = (time.time_ns() - tStart) // 10**6
 		logger.logtrace('Connected to %s in %d ms' % (self.dbType, ms))
+		self.stats['created'] += 1
+		return con
+
+	def _close(self, con):
+		with contextlib.suppress(Exception):
+			con.close()
+
+	def _is_healthy(self, con, idleFor):
+		if self.dbType == 'postgres' and con.closed:
+			return False
+		if idleFor < HEALTHCHECK_AFTER:
+			return True
+		try:
+			with contextlib.closing(con.cursor()) as cur:
+				cur.execute("SELECT 1")
+				cur.fetchall()
+			con.rollback()
+		except Exception as e:
+			logger.logwrn('Discarding broken %s connection - %s: %s' % (self.dbType, e.__class__.__name__, e))
+			return False
+		return True
+
+	def _evict_idle(self):
+		curTime = time.monotonic()
+		keep = []
+		for con, returnedAt in self.idle:
+			if curTime - returnedAt > self.idleTimeout:
+				self._close(con)
+				self.stats['evicted'] += 1
+			else:
+				keep.append((con, returnedAt))
+		self.idle = keep
+
+	def checkout(self):
+		tStart = time.monotonic()
+		with self.lock:
+			while True:
+				self._evict_idle()
+				if self.idle:
+					con, returnedAt = self.idle.pop()
+					break
+				if self.inUse < self.maxSize:
+					con = returnedAt = None
+					if self.inUse >= self.size:
+						self.stats['overflow'] += 1
+					break
+				remaining = self.checkoutTimeout - (time.monotonic() - tStart)
+				if remaining <= 0:
+					self.stats['timeouts'] += 1
+					raise PoolTimeout('No %s connection available after %d seconds' % (self.dbType, self.checkoutTimeout))
+				self.stats['waits'] += 1
+				self.lock.wait(remaining)
+			self.inUse += 1
+			self.stats['peak_in_use'] = max(self.stats['peak_in_use'], self.inUse)
+		try:
+			if con is not None and not self._is_healthy(con, time.monotonic() - returnedAt):
+				self._close(con)
+				self.stats['discarded'] += 1
+				con = None
+			if con is None:
+				con = self._connect()
+			else:
+				self.stats['reused'] += 1
+		except Exception:
+			with self.lock:
+				self.inUse -= 1
+				self.lock.notify()
+			raise
+		ms = (time.monotonic() - tStart) * 1000
+		self.stats['checkouts'] += 1
+		self.stats['checkout_ms_total'] += ms
+		self.stats['checkout_ms_max'] = max(self.stats['checkout_ms_max'], ms)
+		return con
+
+	def checkin(self, con, discard=False):
+		with self.lock:
+			self.inUse -= 1
+			if discard or len(self.idle) >= self.size:
+				self._close(con)
+				self.stats['discarded'] += 1
+			else:
+				self.idle.append((con, time.monotonic()))
+			self.lock.notify()
+
+	def get_stats(self):
+		with self.lock:
+			stats = self.stats.copy()
+			stats['idle'] = len(self.idle)
+			stats['in_use'] = self.inUse
+			stats['size'] = self.size
+			stats['max_size'] = self.maxSize
+		stats['checkout_ms_avg'] = stats['checkout_ms_total'] / stats['checkouts'] if stats['checkouts'] else 0
+		return stats
+
+
+pools = {}
+poolsLock = threading.Lock()
+
+def get_pool(dbType) -> ConnectionPool:
+	with poolsLock:
+		if dbType not in pools:
+			pools[dbType] = ConnectionPool(
+				dbType,
+				st.config['db_pool_size'],
+				st.config['db_pool_max'],
+				st.config['db_pool_idle_timeout'],
+				st.config['db_pool_timeout']
+			)
+		return pools[dbType]
+
+def get_pool_stats():
+	return {dbType: pool.get_stats() for dbType, pool in list(pools.items())}
+
+
+
+class DBRequest:
+	rowcount = 0
+	statusmessage = None
+	def __init__(self, dbType=None):
+		if dbType:
+			self.dbType = dbType
+		else:
+			self.dbType = st.config['database']
+		self.offload = self.dbType == 'sqlite' and use_sqlite_threadpool()
+		self.pool = get_pool(self.dbType)
+		self.con = self.pool.checkout()
+		#Board and author ids resolved in the current transaction, cached once it commits
+		self.pendingIds = {}
+		#Other in-memory updates that only hold once the current transaction commits
+		self.afterCommit = []
 
 	def _convert_query(self, query):
-		if self.dbType == 'postgres':
-			query = query.replace('?', '%s')
-			query = re.sub(re.escape('integer PRIMARY KEY AUTOINCREMENT'), 'bigserial PRIMARY KEY', query, flags=re.IGNORECASE)
-			query = re.sub(re.escape('group_concat'), 'string_agg', query, flags=re.IGNORECASE)
-			query = re.sub(r'(\s)(LIKE)(\s)', r'\1I\2\3', query, flags=re.IGNORECASE)
-		return query
+		return translate_query(self.dbType, query)
 	
 	def _get_ProgrammingError(self):
 		if self.dbType == 'postgres':
@@ -63,15 +484,27 @@ class DBRequest:
 		else:
 			return sqlite3.IntegrityError
 
+	def get_OperationalError(self):
+		if self.dbType == 'postgres':
+			return psycopg2.OperationalError
+		else:
+			return sqlite3.OperationalError
+
 	def _execute_query(self, query, args=tuple(), convert_query=True, return_mode=None):
 		ProgrammingError = self._get_ProgrammingError()
 
-		if convert_query:
-			query = self._convert_query(query)
+		convertedQuery = self._convert_query(query) if convert_query else query
 
 		if args and isinstance(args[0], tuple):
 			args = args[0]
 
+		tStart = time.perf_counter_ns()
+		try:
+			return self._offload(self._run_query, convertedQuery, args, return_mode, ProgrammingError)
+		finally:
+			record_query(query, (time.perf_counter_ns() - tStart) / 10**6)
+
+	def _run_query(self, query, args, return_mode, ProgrammingError):
 		with contextlib.closing(self.con.cursor()) as cur:
 			cur.execute(query, args)
 			self.rowcount = cur.rowcount
@@ -79,12 +512,12 @@ class DBRequest:
 				self.statusmessage = cur.statusmessage
 			if return_mode == 'all':
 				try:
-					return cur.fetchall()
+					return make_rows(cur.description, cur.fetchall())
 				except (ProgrammingError):
 					return []
 			elif return_mode == 'row':
 				try:
-					return cur.fetchone()
+					return make_row(cur.description, cur.fetchone())
 				except (ProgrammingError):
 					return None
 			elif return_mode == 'scalar':
@@ -98,7 +531,15 @@ class DBRequest:
 				except (IndexError, ProgrammingError):
 					return False
 
+	def _offload(self, func, *args):
+		if self.offload:
+			return tpool.execute(func, *args)
+		return func(*args)
+
 	def has_table(self, name):
+		return self._offload(self._has_table, name)
+
+	def _has_table(self, name):
 		with contextlib.closing(self.con.cursor()) as cur:
 			if self.dbType == 'postgres':
 				cur.execute("SELECT * FROM information_schema.tables WHERE table_name=%s", (name.lower(),))
@@ -107,7 +548,22 @@ class DBRequest:
 			r = cur.fetchall()
 		return bool(r)
 
+	def has_index(self, name):
+		return self._offload(self._has_index, name)
+
+	def _has_index(self, name):
+		with contextlib.closing(self.con.cursor()) as cur:
+			if self.dbType == 'postgres':
+				cur.execute("SELECT indexname FROM pg_indexes WHERE indexname=%s", (name.lower(),))
+			else:
+				cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?", (name,))
+			r = cur.fetchall()
+		return bool(r)
+
 	def has_field(self, table, field):
+		return self._offload(self._has_field, table, field)
+
+	def _has_field(self, table, field):
 		with contextlib.closing(self.con.cursor()) as cur:
 			if self.dbType == 'postgres':
 				q = "SELECT column_name FROM information_schema.columns WHERE table_name=%s and column_name=%s;"
@@ -120,6 +576,22 @@ class DBRequest:
 	def exec(self, query, *args):
 		self._execute_query(query, args)
 
+	#Executes a statement once for each tuple of arguments in rows
+	def execmany(self, query, rows):
+		tStart = time.perf_counter_ns()
+		try:
+			self._offload(self._run_many, self._convert_query(query), rows)
+		finally:
+			record_query(query, (time.perf_counter_ns() - tStart) / 10**6)
+
+	def _run_many(self, query, rows):
+		with contextlib.closing(self.con.cursor()) as cur:
+			if self.dbType == 'postgres':
+				psycopg2.extras.execute_batch(cur, query, rows)
+			else:
+				cur.executemany(query, rows)
+			self.rowcount = cur.rowcount
+
 	def query(self, query, *args):
 		tStart = time.time_ns()
 		rows = self._execute_query(query, args, return_mode='all')
@@ -148,102 +620,977 @@ class DBRequest:
 		self.close()
 
 	def commit(self):
-		self.con.commit()
+		self._offload(self.con.commit)
+		self._publish_pending()
 
 	def rollback(self):
-		self.con.rollback()
+		self._offload(self.con.rollback)
+		self._discard_pending_since((0, 0))
+
+	def after_commit(self, func, *args):
+		self.afterCommit.append((func, args))
+
+	def _pending_mark(self):
+		return (len(self.pendingIds), len(self.afterCommit))
+
+	def _publish_pending(self):
+		for (table, key), id in self.pendingIds.items():
+			NAME_TABLES[table].put(key, id)
+		self.pendingIds.clear()
+		callbacks, self.afterCommit = self.afterCommit, []
+		for func, args in callbacks:
+			func(*args)
+
+	def _discard_pending_since(self, mark: tuple):
+		idsMark, callbacksMark = mark
+		for key in list(self.pendingIds)[idsMark:]:
+			del self.pendingIds[key]
+		del self.afterCommit[callbacksMark:]
 
 	def close(self):
-		self.con.commit()
-		self.con.close()
+		if self.con is None:
+			return
+		con, self.con = self.con, None
+		try:
+			self._offload(con.commit)
+		except Exception:
+			self._discard_pending_since((0, 0))
+			self.pool.checkin(con, discard=True)
+			raise
+		else:
+			self._publish_pending()
+			self.pool.checkin(con)
 
 
-boardIds = {}
-authorIds = {}
+#####################
+### Single writer ###
 
-def get_board_id(db: DBRequest, community: str, allow_insert=True):
-	if community.lower() in boardIds:
-		return boardIds[community.lower()]
-	else:
-		if not allow_insert:
-			return 0
-		id = db.queryval("INSERT INTO boards (name) VALUES (?) RETURNING id", community)
-		boardIds[community.lower()] = id
-		logger.logdebug('Assigned id %d to board %s' % (id, community))
+class WriterTimeout(Exception): pass
+
+
+class WriteJob:
+	def __init__(self, func, args, kwargs):
+		self.func = func
+		self.args = args
+		self.kwargs = kwargs
+		self.result = None
+		self.error = None
+		self.cancelled = False
+		self.submitted = time.perf_counter_ns()
+		self.done = threading.Event()
+
+
+#Connection owned by the writer. Jobs run inside a savepoint and are committed in groups
+class WriterDBRequest(DBRequest):
+	jobMark = (0, 0)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		self.exec("ROLLBACK TO SAVEPOINT writer_job")
+		self._discard_pending_since(self.jobMark)
+
+	def commit_batch(self):
+		DBRequest.commit(self)
+
+	def rollback_batch(self):
+		DBRequest.rollback(self)
+
+	def run_job(self, job: WriteJob):
+		if self.dbType == 'sqlite' and not self.con.in_transaction:
+			#Otherwise releasing the savepoint would commit on its own
+			self.exec("BEGIN")
+		self.exec("SAVEPOINT writer_job")
+		self.jobMark = self._pending_mark()
+		try:
+			job.result = job.func(self, *job.args, **job.kwargs)
+		except Exception as e:
+			job.error = e
+			self.rollback()
+		self.exec("RELEASE SAVEPOINT writer_job")
+
+
+class DBWriter:
+	def __init__(self):
+		self.queue = queue.Queue(st.config['writer_queue_size'])
+		self.stats = {
+			'jobs': 0,
+			'failed_jobs': 0,
+			'cancelled_jobs': 0,
+			'batches': 0,
+			'failed_batches': 0,
+			'reconnects': 0,
+			'commit_ms_total': 0,
+			'commit_ms_max': 0,
+			'wait_ms_total': 0,
+			'wait_ms_max': 0
+		}
+
+	def submit(self, func, *args, **kwargs):
+		job = WriteJob(func, args, kwargs)
+		timeout = st.config['writer_timeout']
+		try:
+			self.queue.put(job, timeout=timeout)
+		except queue.Full:
+			raise WriterTimeout('Write queue still full after %d seconds' % timeout)
+		if not job.done.wait(timeout):
+			#Skipped if the writer has not started it yet
+			job.cancelled = True
+			raise WriterTimeout('Write job %s not done after %d seconds' % (func.__name__, timeout))
+		if job.error is not None:
+			raise job.error
+		return job.result
+
+	#Takes whatever queued up behind the first job. Callers are blocked, so an empty queue is never waited on
+	def _next_batch(self) -> list:
+		jobs = [self.queue.get()]
+		while len(jobs) < st.config['writer_batch_size']:
+			try:
+				jobs.append(self.queue.get_nowait())
+			except queue.Empty:
+				break
+		return jobs
+
+	#Rolls back a failed batch. Returns the connection to keep using, or None to reconnect
+	def _recover(self, db: WriterDBRequest, error: Exception):
+		if db is None or db.con is None:
+			return None
+		if not isinstance(error, db.get_OperationalError()):
+			try:
+				db.rollback_batch()
+				return db
+			except Exception as e:
+				error = e
+		logger.logwrn('Reconnecting writer after %s: %s' % (error.__class__.__name__, error))
+		self.stats['reconnects'] += 1
+		con, db.con = db.con, None
+		db.pool.checkin(con, discard=True)
+		return None
+
+	def run(self):
+		db = None
+		while True:
+			jobs = []
+			for job in self._next_batch():
+				if job.cancelled:
+					self.stats['cancelled_jobs'] += 1
+				else:
+					jobs.append(job)
+			if not jobs:
+				continue
+			commitMs = 0
+			try:
+				if db is None:
+					db = WriterDBRequest()
+				for job in jobs:
+					db.run_job(job)
+				tStart = time.perf_counter_ns()
+				db.commit_batch()
+				commitMs = (time.perf_counter_ns() - tStart) / 10**6
+			except Exception as e:
+				logger.logerr('Write batch of %d jobs failed - %s: %s' % (len(jobs), e.__class__.__name__, e))
+				self.stats['failed_batches'] += 1
+				for job in jobs:
+					if job.error is None:
+						job.error = e
+				db = self._recover(db, e)
+			finally:
+				self.stats['batches'] += 1
+				self.stats['commit_ms_total'] += commitMs
+				self.stats['commit_ms_max'] = max(self.stats['commit_ms_max'], commitMs)
+				for job in jobs:
+					waitMs = (time.perf_counter_ns() - job.submitted) / 10**6
+					self.stats['jobs'] += 1
+					self.stats['failed_jobs'] += job.error is not None
+					self.stats['wait_ms_total'] += waitMs
+					self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], waitMs)
+					job.done.set()
+
+	def get_stats(self):
+		stats = self.stats.copy()
+		stats['queue_depth'] = self.queue.qsize()
+		stats['jobs_per_batch_avg'] = round(stats['jobs'] / stats['batches'], 2) if stats['batches'] else 0
+		stats['commit_ms_avg'] = round(stats['commit_ms_total'] / stats['batches'], 2) if stats['batches'] else 0
+		stats['wait_ms_avg'] = round(stats['wait_ms_total'] / stats['jobs'], 2) if stats['jobs'] else 0
+		return stats
+
+
+writer = None
+
+def start_writer():
+	global writer
+	writer = DBWriter()
+	threading.Thread(target=writer.run, name='DBWriter', daemon=True).start()
+	logger.log('Database writes go through a single writer')
+
+def get_writer_stats():
+	return writer.get_stats() if writer else None
+
+#Runs the decorated write function (taking a DBRequest first) on the writer connection, if the writer is running
+def write_job(func):
+	@functools.wraps(func)
+	def wrapper(db, *args, **kwargs):
+		if writer is None or isinstance(db, WriterDBRequest):
+			return func(db, *args, **kwargs)
+		#Releases anything the caller holds, so the writer can't end up waiting on it
+		db.commit()
+		return writer.submit(func, *args, **kwargs)
+	return wrapper
+
+
+
+############################
+### Board and author ids ###
+
+boardIds = LRUCache(10000)
+authorIds = LRUCache(100000)
+
+NAME_TABLES = {
+	'boards': boardIds,
+	'authors': authorIds
+}
+
+#Larger batches are split to stay below the bound parameter limit
+MAX_NAMES_PER_QUERY = 500
+
+#Tables with a unique index on lower(name). Until --dedupe has merged an existing
+#archive's duplicates, its names are inserted without relying on that index.
+uniqueNameTables = set()
+
+def _on_name_conflict(table: str):
+	if table not in uniqueNameTables:
+		return ''
+	return " ON CONFLICT (lower(name)) DO UPDATE SET name = %s.name" % table
+
+
+def _get_name_id(db: DBRequest, table: str, name: str, allow_insert: bool):
+	cache = NAME_TABLES[table]
+	key = name.lower()
+	id = cache.get(key)
+	if id is None:
+		id = db.pendingIds.get((table, key))
+	if id is not None:
 		return id
-	
-def get_author_id(db: DBRequest, author: str, allow_insert=True):
-	if author.lower() in authorIds:
-		return authorIds[author.lower()]
-	else:
+	id = db.queryval("SELECT id FROM %s WHERE lower(name) = ?" % table, key)
+	if id is None:
 		if not allow_insert:
 			return 0
-		id = db.queryval("INSERT INTO authors (name) VALUES (?) RETURNING id", author)
-		authorIds[author.lower()] = id
-		logger.logdebug('Assigned id %d to author %s' % (id, repr(author)))
-		return id
-	
+		#A concurrent insert of the same name resolves to the existing row
+		id = db.queryval("INSERT INTO %s (name) VALUES (?)%s RETURNING id" % (table, _on_name_conflict(table)), name)
+		logger.logdebug('Assigned id %d to %s %s' % (id, table[:-1], repr(name)))
+	db.pendingIds[(table, key)] = id
+	return id
+
+
+def _get_name_ids(db: DBRequest, table: str, names: list, allow_insert: bool) -> dict:
+	cache = NAME_TABLES[table]
+	ids = {}
+	missing = {}
+	for name in names:
+		key = name.lower()
+		if key in ids or key in missing:
+			continue
+		id = cache.get(key)
+		if id is None:
+			id = db.pendingIds.get((table, key))
+		if id is None:
+			missing[key] = name
+		else:
+			ids[key] = id
+
+	missingKeys = list(missing.keys())
+	for i in range(0, len(missingKeys), MAX_NAMES_PER_QUERY):
+		chunk = missingKeys[i:i + MAX_NAMES_PER_QUERY]
+		q = "SELECT id, lower(name) AS lname FROM %s WHERE lower(name) IN (%s)" % (table, ', '.join('?' * len(chunk)))
+		for row in db.query(q, *chunk):
+			if row.lname in missing:
+				ids[row.lname] = row.id
+				db.pendingIds[(table, row.lname)] = row.id
+				del missing[row.lname]
+
+	if missing and allow_insert:
+		newNames = list(missing.values())
+		for i in range(0, len(newNames), MAX_NAMES_PER_QUERY):
+			chunk = newNames[i:i + MAX_NAMES_PER_QUERY]
+			q = "INSERT INTO %s (name) VALUES %s%s RETURNING id, name" % (table, ', '.join(['(?)'] * len(chunk)), _on_name_conflict(table))
+			for row in db.query(q, *chunk):
+				key = row.name.lower()
+				ids[key] = row.id
+				db.pendingIds[(table, key)] = row.id
+				logger.logdebug('Assigned id %d to %s %s' % (row.id, table[:-1], repr(row.name)))
+	else:
+		for key in missing:
+			ids[key] = 0
+	return ids
+
+
+def get_board_id(db: DBRequest, community: str, allow_insert=True):
+	return _get_name_id(db, 'boards', community, allow_insert)
+
+def get_author_id(db: DBRequest, author: str, allow_insert=True):
+	return _get_name_id(db, 'authors', author, allow_insert)
+
+#Resolves several board names at once. Returns a dict keyed by lowercase name
+def get_board_ids(db: DBRequest, communities: list, allow_insert=True) -> dict:
+	return _get_name_ids(db, 'boards', communities, allow_insert)
+
+#Resolves several author names at once. Returns a dict keyed by lowercase name
+def get_author_ids(db: DBRequest, authors: list, allow_insert=True) -> dict:
+	return _get_name_ids(db, 'authors', authors, allow_insert)
+
+
+
+##################################
+### SQLite to Postgres transfer ###
 
+#(table, resume key). Tables without a key are recopied from scratch when interrupted.
+CONVERT_TABLES = [
+	('boards', 'id'),
+	('authors', 'id'),
+	('posts', 'id'),
+	('comments', 'id'),
+	('modlogs', 'created_ms'),
+	('known_bans', None),
+	('removal_requests', None),
+]
+CONVERT_LOG_INTERVAL = 10
+CONVERT_CHECK_ROWS = 100
 
-def convert_database(db1: DBRequest, db2: DBRequest):
-	for row in db1.query("SELECT id, name FROM boards ORDER BY id"):
-		db2.exec("INSERT INTO boards (name) VALUES (?)", row.name)
+def _copy_value(value):
+	if value is None:
+		return '\\N'
+	if isinstance(value, (bytes, memoryview)):
+		return '\\\\x' + bytes(value).hex()
+	if isinstance(value, float) and value.is_integer():
+		value = int(value)
+	return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
+def _copy_rows(db: DBRequest, table: str, columns: list, rows: list):
+	buf = io.StringIO()
+	for row in rows:
+		buf.write('\t'.join(_copy_value(value) for value in row))
+		buf.write('\n')
+	buf.seek(0)
+	with contextlib.closing(db.con.cursor()) as cur:
+		cur.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
 
-def _perform_db_upgrades(db: DBRequest):
-	if not db.has_field('comments', 'known_deleted'):
-		db.exec("ALTER TABLE comments ADD COLUMN known_deleted boolean DEFAULT FALSE")
+def _table_columns(db: DBRequest, table: str) -> list:
+	return [row.column_name for row in db.query("SELECT column_name FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position", table)]
 
-	if not db.has_field('posts', 'recovery_method'):
-		db.exec("UPDATE posts SET archived_at_ms = archived_at_ms / 1000")
-		db.exec("ALTER TABLE posts ADD COLUMN recovery_method text DEFAULT NULL")
-		fromScrape = [row.id for row in db.query("SELECT id FROM posts WHERE recovered_from_scrape")]
-		for id in fromScrape:
-			db.exec("UPDATE posts SET recovery_method = 'scrape' WHERE id = ?", id)
-		fromLog = [row.id for row in db.query("SELECT id FROM posts WHERE recovered_from_log")]
-		for id in fromLog:
-			db.exec("UPDATE posts SET recovery_method = 'log' WHERE id = ?", id)
-		db.exec("ALTER TABLE posts DROP column recovered_from_scrape")
-		db.exec("ALTER TABLE posts DROP column recovered_from_log")
+def _convert_table(src: DBRequest, dst: DBRequest, table: str, key: str, batchSize: int):
+	metaKey = 'convert_%s' % table
+	checkpoint = get_meta(dst, metaKey)
+	if checkpoint == 'done':
+		logger.log('Skipping %s, already converted' % table)
+		return
+	columns = _table_columns(dst, table)
+	query = "SELECT %s FROM %s" % (', '.join(columns), table)
+	args = ()
+	if key is None:
+		dst.exec("DELETE FROM %s" % table)
+	elif checkpoint is not None:
+		logger.log('Resuming %s after %s %s' % (table, key, checkpoint))
+		query += " WHERE %s > ?" % key
+		args = (int(checkpoint),)
+	if key is not None:
+		query += " ORDER BY %s" % key
+		keyIndex = columns.index(key)
+
+	total = src.queryval("SELECT COUNT(*) FROM %s" % table)
+	copied = 0
+	tStart = time.time()
+	tLogged = tStart
+	cur = src.con.cursor()
+	try:
+		src._offload(cur.execute, query, args)
+		while True:
+			rows = src._offload(cur.fetchmany, batchSize)
+			if not rows:
+				break
+			_copy_rows(dst, table, columns, rows)
+			if key is not None:
+				#Commits the batch together with its checkpoint
+				set_meta(dst, metaKey, rows[-1][keyIndex])
+			copied += len(rows)
+			if time.time() - tLogged >= CONVERT_LOG_INTERVAL:
+				tLogged = time.time()
+				logger.log('%s: %d rows copied, %d in source (%.0f rows/s)' % (table, copied, total, copied / (tLogged - tStart)))
+	finally:
+		cur.close()
+	set_meta(dst, metaKey, 'done')
+	elapsed = max(time.time() - tStart, 0.001)
+	logger.log('%s: %d rows copied in %.1f s (%.0f rows/s)' % (table, copied, elapsed, copied / elapsed))
+
+#Compressed bodies reference dictionaries stored in db_meta, so they have to travel with the rows
+def _convert_zdicts(src: DBRequest, dst: DBRequest):
+	for row in src.query("SELECT key, value FROM db_meta WHERE key LIKE 'zdict_%'"):
+		existing = get_meta(dst, row.key)
+		if existing is not None and existing != row.value:
+			raise ValueError('Target database already has a different %s' % row.key)
+		set_meta(dst, row.key, row.value)
+
+#Reads back a sample of compressed bodies from the target with its own dictionaries
+def _check_compressed(dst: DBRequest, table: str):
+	zdicts = {0: b''}
+	checked = 0
+	for order in ('ASC', 'DESC'):
+		for row in dst.query("SELECT id, raw_content_z FROM %s WHERE raw_content_z IS NOT NULL ORDER BY id %s LIMIT %d" % (table, order, CONVERT_CHECK_ROWS)):
+			blob = bytes(row.raw_content_z)
+			if blob[0] not in zdicts:
+				value = get_meta(dst, 'zdict_%d' % blob[0])
+				if value is None:
+					raise ValueError('%s %d uses compression dictionary %d, which is missing from the target' % (table, row.id, blob[0]))
+				zdicts[blob[0]] = base64.b64decode(value)
+			zdict = zdicts[blob[0]]
+			decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+			try:
+				(decompressor.decompress(blob[1:]) + decompressor.flush()).decode()
+			except (zlib.error, UnicodeDecodeError) as e:
+				raise ValueError('%s %d cannot be read back after conversion: %s' % (table, row.id, e))
+			checked += 1
+	if checked:
+		logger.log('%s: %d compressed rows read back' % (table, checked))
+
+#Streams every table of a SQLite archive into Postgres, keeping ids. Resumes where it stopped
+def convert_database(src: DBRequest, dst: DBRequest):
+	if src.dbType != 'sqlite' or dst.dbType != 'postgres':
+		raise ValueError('Conversion only supports SQLite to Postgres')
+	if get_schema_version(src) < MIGRATIONS[-1][0] or not src.has_index('idx_authors_name'):
+		raise ValueError('Source database is not up to date, start the server on it once before converting')
+	#COPY is not supported while the eventlet wait callback is registered
+	make_postgres_blocking()
+	batchSize = st.config['convert_batch_size']
+	tStart = time.time()
+	_convert_zdicts(src, dst)
+	for table, key in CONVERT_TABLES:
+		_convert_table(src, dst, table, key, batchSize)
+	for table in ('posts', 'comments'):
+		_check_compressed(dst, table)
+	for table in ('boards', 'authors'):
+		dst.exec("SELECT setval(pg_get_serial_sequence('%s', 'id'), (SELECT COALESCE(MAX(id), 0) + 1 FROM %s), false)" % (table, table))
+	logger.log('Rebuilding derived tables')
+	dst.exec("DELETE FROM ban_status")
+	dst.exec(BAN_STATUS_FILL)
+	dst.exec("DELETE FROM board_moderators")
+	dst.exec(BOARD_MODERATORS_FILL)
+	dst.commit()
+	boardIds.clear()
+	authorIds.clear()
+	logger.log('Conversion finished in %.1f s' % (time.time() - tStart))
+
+
+def get_meta(db: DBRequest, key: str, default=None):
+	value = db.queryval("SELECT value FROM db_meta WHERE key = ?", key)
+	return default if value is None else value
+
+def set_meta(db: DBRequest, key: str, value):
+	db.exec("DELETE FROM db_meta WHERE key = ?", key)
+	db.exec("INSERT INTO db_meta (key, value) VALUES (?, ?)", key, str(value))
+	db.commit()
+
+
+
+###############
+### Indexes ###
+
+INDEX_VERSION = 1
+
+INDEXES = [
+	('idx_posts_author', 'posts', 'author_id, id'),
+	('idx_posts_board', 'posts', 'board_id, id'),
+	('idx_comments_post', 'comments', 'post_id'),
+	('idx_comments_author', 'comments', 'author_id, id'),
+	('idx_modlogs_board', 'modlogs', 'board_id, created_ms'),
+	('idx_known_bans_target', 'known_bans', 'board_id, target_id'),
+]
+
+UNIQUE_NAME_INDEXES = [
+	('idx_boards_name', 'boards'),
+	('idx_authors_name', 'authors'),
+]
+
+def _create_index(db: DBRequest, name: str, table: str, columns: str, unique=False):
+	tStart = time.time_ns()
+	if db.dbType == 'postgres':
+		#Built without locking writes; has to run outside of a transaction
+		valid = db.queryval("SELECT pg_index.indisvalid FROM pg_index INNER JOIN pg_class ON pg_class.oid = pg_index.indexrelid WHERE pg_class.relname = ?", name)
 		db.commit()
-	
-	if not db.has_field('comments', 'recovery_method'):
-		db.exec("UPDATE comments SET archived_at_ms = archived_at_ms / 1000")
-		db.exec("ALTER TABLE comments ADD COLUMN recovery_method text DEFAULT NULL")
-		fromLog = [row.id for row in db.query("SELECT id FROM comments WHERE recovered_from_log")]
-		for id in fromLog:
-			db.exec("UPDATE comments SET recovery_method = 'log' WHERE id = ?", id)
-		db.exec("ALTER TABLE comments DROP column recovered_from_log")
+		db.con.autocommit = True
+		try:
+			if valid is False:
+				logger.logwrn('Rebuilding invalid index %s' % name)
+				db.exec("DROP INDEX CONCURRENTLY IF EXISTS %s" % name)
+			#Partitioned tables cannot be indexed concurrently; their partitions are indexed one by one instead
+			concurrently = '' if is_partitioned(db, table) else 'CONCURRENTLY '
+			db.exec("CREATE %sINDEX %sIF NOT EXISTS %s ON %s (%s)" % ('UNIQUE ' if unique else '', concurrently, name, table, columns))
+		finally:
+			db.con.autocommit = False
+	else:
+		db.exec("CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % ('UNIQUE ' if unique else '', name, table, columns))
 		db.commit()
-	
-	if not db.has_field('posts', 'removal_source'):
-		db.exec("ALTER TABLE posts ADD COLUMN removal_source text DEFAULT NULL")
-		db.exec("UPDATE posts SET removal_source = 'unknown' WHERE recovery_method IS NOT NULL")
-		db.exec("UPDATE posts SET removal_source = 'unknown' WHERE title = ''")
-		cfIds = [row.id for row in db.query("SELECT id FROM posts WHERE removed_by = 'CommunityFilter' OR removed_by = 'Filter'")]
-		gfIds = [row.id for row in db.query("SELECT id FROM posts WHERE removed_by = 'GlobalFilter'")]
-		for id in cfIds:
-			db.exec("UPDATE posts SET removal_source = 'communityFilter' WHERE id = ?", id)
-		for id in gfIds:
-			db.exec("UPDATE posts SET removal_source = 'spamFilter' WHERE id = ?", id)
+	ms = (time.time_ns() - tStart) // 10**6
+	logger.log('Index %s on %s (%s) ready in %d ms' % (name, table, columns, ms))
+
+def _upgrade_indexes(db: DBRequest):
+	version = int(get_meta(db, 'index_version', 0))
+	if version >= INDEX_VERSION:
+		return
+	logger.log('Upgrading indexes from version %d to %d' % (version, INDEX_VERSION))
+	for name, table, columns in INDEXES:
+		_create_index(db, name, table, columns)
+	set_meta(db, 'index_version', INDEX_VERSION)
+
+
+#Returns the lines of the query plan chosen by the database
+def explain_query(db: DBRequest, query: str, *args):
+	if db.dbType == 'postgres':
+		#Small tables are otherwise always scanned sequentially
+		db.exec("SET enable_seqscan = off")
+		try:
+			return [row[0] for row in db.query("EXPLAIN " + query, *args)]
+		finally:
+			db.exec("RESET enable_seqscan")
+	else:
+		return [row[3] for row in db.query("EXPLAIN QUERY PLAN " + query, *args)]
+
+#Returns the plan lines of a query that read a whole table
+def find_table_scans(db: DBRequest, query: str, *args):
+	scans = []
+	for line in explain_query(db, query, *args):
+		line = line.strip()
+		if db.dbType == 'postgres':
+			if 'Seq Scan on' in line:
+				scans.append(line)
+		elif line.startswith('SCAN ') and not line.startswith('SCAN CONSTANT ROW'):
+			scans.append(line)
+	return scans
+
+
+
+BAN_STATUS_SELECT = """
+	SELECT
+		known_bans.board_id,
+		known_bans.target_id,
+		known_bans.permabanned,
+		known_bans.nuked_at_ms,
+		moderators.name,
+		known_bans.reason
+	FROM known_bans
+	LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
+"""
+
+#Rebuilds the ban_status row of one author in one board from known_bans
+def refresh_ban_status(db: DBRequest, board_id: int, author_id: int):
+	db.exec("DELETE FROM ban_status WHERE board_id = ? AND author_id = ?", board_id, author_id)
+	db.exec(
+		"INSERT INTO ban_status (board_id, author_id, is_banned, nuked_at_ms, banned_by, ban_reason) " +
+		BAN_STATUS_SELECT + "WHERE known_bans.board_id = ? AND known_bans.target_id = ? LIMIT 1",
+		board_id,
+		author_id
+	)
+
+BAN_STATUS_FILL = (
+	"INSERT INTO ban_status (board_id, author_id, is_banned, nuked_at_ms, banned_by, ban_reason) " +
+	BAN_STATUS_SELECT + "WHERE TRUE ON CONFLICT (board_id, author_id) DO NOTHING"
+)
+
+def _create_ban_status(db: DBRequest):
+	logger.log('Building ban_status from known_bans')
+	db.exec("""
+		CREATE TABLE ban_status (
+			board_id integer NOT NULL,
+			author_id integer NOT NULL,
+			is_banned boolean DEFAULT FALSE,
+			nuked_at_ms bigint DEFAULT 0,
+			banned_by text,
+			ban_reason text,
+			PRIMARY KEY (board_id, author_id)
+		);
+	""")
+	db.exec(BAN_STATUS_FILL)
+	db.commit()
+
+
+BOARD_MODERATORS_FILL = """
+	INSERT INTO board_moderators (board_id, moderator_id, name)
+	SELECT DISTINCT modlogs.board_id, modlogs.moderator_id, authors.name
+	FROM modlogs
+	INNER JOIN authors ON authors.id = modlogs.moderator_id
+	WHERE TRUE
+	ON CONFLICT (board_id, moderator_id) DO NOTHING
+"""
+
+def _create_board_moderators(db: DBRequest):
+	logger.log('Building moderator rosters from modlogs')
+	db.exec("""
+		CREATE TABLE board_moderators (
+			board_id integer NOT NULL,
+			moderator_id integer NOT NULL,
+			name text,
+			PRIMARY KEY (board_id, moderator_id)
+		);
+	""")
+	db.exec(BOARD_MODERATORS_FILL)
+	db.commit()
+
+
+##################################
+### Duplicate board and author ###
+
+#Columns referencing board and author ids. Derived tables are rebuilt for the merged ids afterwards.
+NAME_REFERENCES = {
+	'boards': [('posts', 'board_id'), ('comments', 'board_id'), ('modlogs', 'board_id'), ('known_bans', 'board_id')],
+	'authors': [('posts', 'author_id'), ('comments', 'author_id'), ('modlogs', 'moderator_id'), ('modlogs', 'target_id'), ('known_bans', 'moderator_id'), ('known_bans', 'target_id')]
+}
+NAME_DERIVED_REFERENCES = {
+	'boards': [('ban_status', 'board_id'), ('board_moderators', 'board_id')],
+	'authors': [('ban_status', 'author_id'), ('board_moderators', 'moderator_id')]
+}
+
+def _merge_duplicates(db: DBRequest, table: str) -> int:
+	db.exec("DROP TABLE IF EXISTS name_merge")
+	db.exec("CREATE TEMPORARY TABLE name_merge (old_id integer PRIMARY KEY, new_id integer NOT NULL)")
+	db.exec("""
+		INSERT INTO name_merge (old_id, new_id)
+		SELECT t.id, keep.id
+		FROM %s AS t
+		INNER JOIN (
+			SELECT lower(name) AS lname, MIN(id) AS id FROM %s GROUP BY lower(name) HAVING COUNT(*) > 1
+		) AS keep ON keep.lname = lower(t.name)
+		WHERE t.id <> keep.id
+	""" % (table, table))
+	merged = db.queryval("SELECT COUNT(*) FROM name_merge")
+	if merged:
+		for refTable, column in NAME_REFERENCES[table]:
+			db.exec(
+				"UPDATE %s SET %s = (SELECT new_id FROM name_merge WHERE old_id = %s.%s) WHERE %s IN (SELECT old_id FROM name_merge)"
+				% (refTable, column, refTable, column, column)
+			)
+		for refTable, column in NAME_DERIVED_REFERENCES[table]:
+			db.exec(
+				"DELETE FROM %s WHERE %s IN (SELECT old_id FROM name_merge) OR %s IN (SELECT new_id FROM name_merge)"
+				% (refTable, column, column)
+			)
+		knownBansColumn = 'board_id' if table == 'boards' else 'target_id'
+		db.exec(
+			"INSERT INTO ban_status (board_id, author_id, is_banned, nuked_at_ms, banned_by, ban_reason) " +
+			BAN_STATUS_SELECT + "WHERE known_bans.%s IN (SELECT new_id FROM name_merge) " % knownBansColumn +
+			"ON CONFLICT (board_id, author_id) DO NOTHING"
+		)
+		modlogsColumn = 'board_id' if table == 'boards' else 'moderator_id'
+		db.exec("""
+			INSERT INTO board_moderators (board_id, moderator_id, name)
+			SELECT DISTINCT modlogs.board_id, modlogs.moderator_id, authors.name
+			FROM modlogs
+			INNER JOIN authors ON authors.id = modlogs.moderator_id
+			WHERE modlogs.%s IN (SELECT new_id FROM name_merge)
+			ON CONFLICT (board_id, moderator_id) DO NOTHING
+		""" % modlogsColumn)
+		db.exec("DELETE FROM %s WHERE id IN (SELECT old_id FROM name_merge)" % table)
+	db.exec("DROP TABLE name_merge")
+	return merged
+
+#Merges boards and authors whose names differ only in case into the lowest id, then makes names unique
+def merge_duplicate_names(db: DBRequest):
+	tStart = time.time_ns()
+	try:
+		boardsMerged = _merge_duplicates(db, 'boards')
+		authorsMerged = _merge_duplicates(db, 'authors')
 		db.commit()
-	
-	if not db.has_field('comments', 'removal_source'):
-		db.exec("ALTER TABLE comments ADD COLUMN removal_source text DEFAULT NULL")
-		db.exec("UPDATE comments SET removal_source = 'unknown' WHERE recovery_method IS NOT NULL")
-		db.exec("UPDATE comments SET removal_source = 'unknown' WHERE raw_content = ''")
-		cfIds = [row.id for row in db.query("SELECT id FROM comments WHERE removed_by = 'CommunityFilter' OR removed_by = 'Filter'")]
-		gfIds = [row.id for row in db.query("SELECT id FROM comments WHERE removed_by = 'GlobalFilter'")]
-		for id in cfIds:
-			db.exec("UPDATE comments SET removal_source = 'communityFilter' WHERE id = ?", id)
-		for id in gfIds:
-			db.exec("UPDATE comments SET removal_source = 'spamFilter' WHERE id = ?", id)
+	except Exception:
+		db.rollback()
+		raise
+	boardIds.clear()
+	authorIds.clear()
+	ms = (time.time_ns() - tStart) // 10**6
+	logger.log('Merged %d duplicate boards and %d duplicate authors in %d ms' % (boardsMerged, authorsMerged, ms))
+	for name, table in UNIQUE_NAME_INDEXES:
+		_create_index(db, name, table, 'lower(name)', unique=True)
+		uniqueNameTables.add(table)
+
+def has_duplicate_names(db: DBRequest, table: str) -> bool:
+	return db.queryexists("SELECT lower(name) FROM %s GROUP BY lower(name) HAVING COUNT(*) > 1 LIMIT 1" % table)
+
+#Makes names unique where that needs no merge. Merging duplicates is left to --dedupe
+def _check_unique_names(db: DBRequest):
+	for name, table in UNIQUE_NAME_INDEXES:
+		if db.has_index(name):
+			uniqueNameTables.add(table)
+		elif has_duplicate_names(db, table):
+			logger.logwrn('%s contains names differing only in case, run with --dedupe to merge them' % table)
+		else:
+			_create_index(db, name, table, 'lower(name)', unique=True)
+			uniqueNameTables.add(table)
+
+
+####################
+### Partitioning ###
+
+#Postgres only: posts and comments become range partitioned by id. SQLite has no
+#partitioned tables, and routing every query across attached files would not keep
+#ON CONFLICT upserts working, so SQLite archives stay unpartitioned.
+PARTITIONED_TABLES = ['posts', 'comments']
+
+def is_partitioned(db: DBRequest, table: str) -> bool:
+	if db.dbType != 'postgres':
+		return False
+	return db.queryexists("SELECT 1 FROM pg_class WHERE relname = ? AND relkind = 'p'", table)
+
+#Turns an existing table into the first partition of a new partitioned table of the same name
+def _partition_table(db: DBRequest, table: str):
+	size = st.config['partition_size']
+	maxId = db.queryval("SELECT MAX(id) FROM %s" % table) or 0
+	upper = (maxId // size + 1) * size
+	legacy = '%s_legacy' % table
+	logger.log('Partitioning %s, existing rows up to id %d stay in %s' % (table, upper, legacy))
+	tStart = time.time_ns()
+	try:
+		db.exec("ALTER TABLE %s RENAME TO %s" % (table, legacy))
+		db.exec("ALTER TABLE %s RENAME CONSTRAINT %s_pkey TO %s_pkey" % (legacy, table, legacy))
+		for name, indexTable, columns in INDEXES:
+			if indexTable == table:
+				db.exec("ALTER INDEX IF EXISTS %s RENAME TO %s_legacy" % (name, name))
+		db.exec("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS, PRIMARY KEY (id)) PARTITION BY RANGE (id)" % (table, legacy))
+		#Validating the range scans the legacy table once
+		db.exec("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%d)" % (table, legacy, upper))
+		db.exec("CREATE TABLE %s_default PARTITION OF %s DEFAULT" % (table, table))
+		set_meta(db, 'partition_%s_upper' % table, upper)
+	except Exception:
+		db.rollback()
+		raise
+	for name, indexTable, columns in INDEXES:
+		if indexTable == table:
+			#Attaches the equivalent legacy index instead of building a new one
+			_create_index(db, name, table, columns)
+	ms = (time.time_ns() - tStart) // 10**6
+	logger.log('Partitioned %s in %d ms' % (table, ms))
+
+def _add_partition(db: DBRequest, table: str, lower: int, upper: int):
+	name = '%s_p%d' % (table, lower // st.config['partition_size'])
+	db.exec("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (name, table))
+	#Rows that already landed in the default partition have to move before the range can be attached
+	db.exec("""
+		WITH moved AS (DELETE FROM %s_default WHERE id >= ? AND id < ? RETURNING *)
+		INSERT INTO %s SELECT * FROM moved
+	""" % (table, name), lower, upper)
+	db.exec("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%d) TO (%d)" % (table, name, lower, upper))
+	set_meta(db, 'partition_%s_upper' % table, upper)
+	logger.log('Created partition %s for ids %d to %d' % (name, lower, upper))
+
+#Keeps `partitions_ahead` empty partitions above the highest id of each partitioned table
+def ensure_partitions(db: DBRequest):
+	if db.dbType != 'postgres' or not st.config['partitioning']:
+		return
+	size = st.config['partition_size']
+	for table in PARTITIONED_TABLES:
+		if not is_partitioned(db, table):
+			_partition_table(db, table)
+		upper = int(get_meta(db, 'partition_%s_upper' % table))
+		maxId = db.queryval("SELECT MAX(id) FROM %s" % table) or 0
+		target = (maxId // size + 1 + st.config['partitions_ahead']) * size
+		while upper < target:
+			try:
+				_add_partition(db, table, upper, upper + size)
+			except Exception:
+				db.rollback()
+				raise
+			upper += size
+
+def get_partition_stats(db: DBRequest) -> list:
+	if db.dbType != 'postgres':
+		return []
+	return db.query("""
+		SELECT parent.relname AS table_name, child.relname AS partition, pg_get_expr(child.relpartbound, child.oid) AS bounds,
+			child.reltuples::bigint AS estimated_rows, pg_total_relation_size(child.oid) AS total_bytes
+		FROM pg_inherits
+		INNER JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+		INNER JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+		WHERE parent.relname IN ('posts', 'comments')
+		ORDER BY parent.relname, child.relname
+	""")
+
+
+
+##################
+### Migrations ###
+
+MIGRATION_LOG_INTERVAL = 10
+
+#The checkpoint holds the last backfilled id, or BACKFILL_DONE once the last chunk is committed
+BACKFILL_DONE = 'done'
+
+def _checkpoint_key(version: int):
+	return 'migration_%d_checkpoint' % version
+
+def _backfill_done(db: DBRequest, version: int) -> bool:
+	return get_meta(db, _checkpoint_key(version)) == BACKFILL_DONE
+
+#Applies `assignments` to every row of `table` in id-ordered chunks, resuming from the stored checkpoint
+def _backfill(db: DBRequest, version: int, table: str, assignments: str):
+	checkpoint = get_meta(db, _checkpoint_key(version))
+	if checkpoint is None or checkpoint == BACKFILL_DONE:
+		return
+	lastId = int(checkpoint)
+	chunkSize = st.config['migration_chunk_size']
+	maxId = db.queryval("SELECT MAX(id) FROM %s" % table) or 0
+	logger.log('Backfilling %s from id %d (migration %d)' % (table, lastId, version))
+	rows = 0
+	tStart = time.time()
+	tLogged = tStart
+	while True:
+		upperId = db.queryval("SELECT MAX(id) FROM (SELECT id FROM %s WHERE id > ? ORDER BY id LIMIT ?) AS chunk" % table, lastId, chunkSize)
+		if upperId is None:
+			set_meta(db, _checkpoint_key(version), BACKFILL_DONE)
+			break
+		db.exec("UPDATE %s SET %s WHERE id > ? AND id <= ?" % (table, assignments), lastId, upperId)
+		rows += db.rowcount
+		lastId = upperId
+		#Committed together with the chunk, so a chunk is never applied twice
+		set_meta(db, _checkpoint_key(version), BACKFILL_DONE if upperId >= maxId else lastId)
+		if upperId >= maxId:
+			break
+		if time.time() - tLogged >= MIGRATION_LOG_INTERVAL:
+			tLogged = time.time()
+			logger.log('Migration %d: %d rows of %s updated, at id %d of %d (%.0f rows/s)' % (version, rows, table, lastId, maxId, rows / (tLogged - tStart)))
+	elapsed = max(time.time() - tStart, 0.001)
+	logger.log('Migration %d: %d rows of %s updated in %.1f s (%.0f rows/s)' % (version, rows, table, elapsed, rows / elapsed))
+
+#Adds a column. SQLite commits ALTER TABLE by itself, so the backfill checkpoint is stored first
+def _add_column(db: DBRequest, version: int, table: str, column: str, backfill: bool):
+	if not db.has_field(table, column.split()[0]):
+		if backfill:
+			set_meta(db, _checkpoint_key(version), 0)
+		db.exec("ALTER TABLE %s ADD COLUMN %s" % (table, column))
 		db.commit()
 
+#Starts a backfill out of legacy columns unless one is already under way or finished
+def _start_backfill(db: DBRequest, version: int):
+	if get_meta(db, _checkpoint_key(version)) is None:
+		set_meta(db, _checkpoint_key(version), 0)
+
+#Legacy columns are only dropped once their backfill has committed its last chunk
+def _drop_legacy_column(db: DBRequest, version: int, table: str, column: str):
+	if db.has_field(table, column) and _backfill_done(db, version):
+		db.exec("ALTER TABLE %s DROP column %s" % (table, column))
+		db.commit()
+
+
+def _migrate_comments_known_deleted(db: DBRequest):
+	_add_column(db, 1, 'comments', 'known_deleted boolean DEFAULT FALSE', False)
+
+#Whether the legacy columns are still there decides if a backfill is needed, not whether the new column exists
+def _migrate_posts_recovery_method(db: DBRequest):
+	legacy = db.has_field('posts', 'recovered_from_log') and db.has_field('posts', 'recovered_from_scrape')
+	if legacy:
+		_start_backfill(db, 2)
+	_add_column(db, 2, 'posts', 'recovery_method text DEFAULT NULL', False)
+	if legacy:
+		_backfill(db, 2, 'posts', """
+			archived_at_ms = archived_at_ms / 1000,
+			recovery_method = CASE WHEN recovered_from_log THEN 'log' WHEN recovered_from_scrape THEN 'scrape' ELSE NULL END
+		""")
+	_drop_legacy_column(db, 2, 'posts', 'recovered_from_scrape')
+	_drop_legacy_column(db, 2, 'posts', 'recovered_from_log')
+
+def _migrate_comments_recovery_method(db: DBRequest):
+	legacy = db.has_field('comments', 'recovered_from_log')
+	if legacy:
+		_start_backfill(db, 3)
+	_add_column(db, 3, 'comments', 'recovery_method text DEFAULT NULL', False)
+	if legacy:
+		_backfill(db, 3, 'comments', """
+			archived_at_ms = archived_at_ms / 1000,
+			recovery_method = CASE WHEN recovered_from_log THEN 'log' ELSE NULL END
+		""")
+	_drop_legacy_column(db, 3, 'comments', 'recovered_from_log')
+
+def _migrate_posts_removal_source(db: DBRequest):
+	_add_column(db, 4, 'posts', 'removal_source text DEFAULT NULL', True)
+	_backfill(db, 4, 'posts', """
+		removal_source = CASE
+			WHEN removed_by = 'CommunityFilter' OR removed_by = 'Filter' THEN 'communityFilter'
+			WHEN removed_by = 'GlobalFilter' THEN 'spamFilter'
+			WHEN recovery_method IS NOT NULL OR title = '' THEN 'unknown'
+			ELSE removal_source
+		END
+	""")
+
+def _migrate_comments_removal_source(db: DBRequest):
+	_add_column(db, 5, 'comments', 'removal_source text DEFAULT NULL', True)
+	_backfill(db, 5, 'comments', """
+		removal_source = CASE
+			WHEN removed_by = 'CommunityFilter' OR removed_by = 'Filter' THEN 'communityFilter'
+			WHEN removed_by = 'GlobalFilter' THEN 'spamFilter'
+			WHEN recovery_method IS NOT NULL OR raw_content = '' THEN 'unknown'
+			ELSE removal_source
+		END
+	""")
+
+def _migrate_compressed_content(db: DBRequest):
+	blobType = 'bytea' if db.dbType == 'postgres' else 'blob'
+	_add_column(db, 8, 'posts', 'raw_content_z %s DEFAULT NULL' % blobType, False)
+	_add_column(db, 8, 'comments', 'raw_content_z %s DEFAULT NULL' % blobType, False)
+
+def _migrate_ban_status(db: DBRequest):
+	if not db.has_table('ban_status'):
+		_create_ban_status(db)
+
+def _migrate_board_moderators(db: DBRequest):
+	if not db.has_table('board_moderators'):
+		_create_board_moderators(db)
+
+
+#Each migration must be safe to re-run after a crash; it is recorded once it returns
+MIGRATIONS = [
+	(1, 'comments_known_deleted', _migrate_comments_known_deleted),
+	(2, 'posts_recovery_method', _migrate_posts_recovery_method),
+	(3, 'comments_recovery_method', _migrate_comments_recovery_method),
+	(4, 'posts_removal_source', _migrate_posts_removal_source),
+	(5, 'comments_removal_source', _migrate_comments_removal_source),
+	(6, 'ban_status', _migrate_ban_status),
+	(7, 'board_moderators', _migrate_board_moderators),
+	(8, 'compressed_content', _migrate_compressed_content),
+]
+
+def get_schema_version(db: DBRequest) -> int:
+	return db.queryval("SELECT MAX(version) FROM schema_migrations") or 0
+
+def run_migrations(db: DBRequest):
+	db.exec("""
+		CREATE TABLE IF NOT EXISTS schema_migrations (
+			version integer PRIMARY KEY,
+			name text,
+			applied_at_ms bigint
+		);
+	""")
+	db.commit()
+	applied = {row.version for row in db.query("SELECT version FROM schema_migrations")}
+	for version, name, migrate in MIGRATIONS:
+		if version in applied:
+			continue
+		logger.log('Applying migration %d: %s' % (version, name))
+		tStart = time.time_ns()
+		try:
+			migrate(db)
+			db.exec("DELETE FROM db_meta WHERE key = ?", _checkpoint_key(version))
+			db.exec("INSERT INTO schema_migrations (version, name, applied_at_ms) VALUES (?, ?, ?)", version, name, time.time_ns() // 10**6)
+			db.commit()
+		except Exception:
+			db.rollback()
+			logger.logerr('Migration %d failed, it will resume from its last checkpoint on the next run' % version)
+			raise
+		ms = (time.time_ns() - tStart) // 10**6
+		logger.log('Migration %d applied in %d ms' % (version, ms))
+
 
 
 def init_database():
 	logger.log('Preparing database')
+	if st.config['database'] == 'postgres' and st.config['postgres_green']:
+		make_postgres_green()
+	if st.config['sqlite_threadpool']:
+		start_sqlite_threadpool()
 	db = DBRequest()
 
 	db.exec("""
@@ -275,6 +1622,7 @@ def init_database():
 			created_ms bigint,
 			archived_at_ms bigint,
 			known_deleted boolean DEFAULT FALSE,
+			recovery_method text DEFAULT NULL,
 			removal_source text DEFAULT NULL,
 			approved_at_ms bigint DEFAULT NULL,
 			approved_by text DEFAULT NULL,
@@ -298,6 +1646,7 @@ def init_database():
 			created_ms bigint,
 			archived_at_ms bigint,
 			known_deleted boolean DEFAULT FALSE,
+			recovery_method text DEFAULT NULL,
 			removal_source text DEFAULT NULL,
 			approved_at_ms bigint DEFAULT NULL,
 			approved_by text DEFAULT NULL,
@@ -340,6 +1689,13 @@ def init_database():
 		);
 	""")
 
+	db.exec("""
+		CREATE TABLE IF NOT EXISTS db_meta (
+			key text PRIMARY KEY,
+			value text
+		);
+	""")
+
 	db.exec("""
 		CREATE TABLE IF NOT EXISTS removal_requests (
 			time bigint,
@@ -352,29 +1708,15 @@ def init_database():
 		);
 	""")
 
-	_perform_db_upgrades(db)
+	run_migrations(db)
+	_upgrade_indexes(db)
 
-	for row in db.query("SELECT id, name FROM boards ORDER BY id"):
-		if row.name.lower() in boardIds:
-			logger.logwrn('Removing duplicate board id: %d %s' % (row.id, row.name))
-			db.exec("UPDATE posts SET board_id = ? WHERE board_id = ?", boardIds[row.name.lower()], row.id)
-			db.exec("UPDATE comments SET board_id = ? WHERE board_id = ?", boardIds[row.name.lower()], row.id)
-			db.exec("UPDATE modlogs SET board_id = ? WHERE board_id = ?", boardIds[row.name.lower()], row.id)
-			db.exec("UPDATE known_bans SET board_id = ? WHERE board_id = ?", boardIds[row.name.lower()], row.id)
-			db.exec("DELETE FROM boards WHERE id = ?", row.id)
+	_check_unique_names(db)
+	if st.config['partitioning']:
+		if db.dbType == 'postgres':
+			ensure_partitions(db)
 		else:
-			boardIds[row.name.lower()] = row.id
-
-	for row in db.query("SELECT id, name FROM authors ORDER BY id"):
-		if row.name.lower() in authorIds:
-			logger.logwrn('Removing duplicate author id: %d %s' % (row.id, row.name))
-			db.exec("UPDATE posts SET author_id = ? WHERE author_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("UPDATE comments SET author_id = ? WHERE author_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("UPDATE modlogs SET moderator_id = ? WHERE moderator_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("UPDATE modlogs SET target_id = ? WHERE target_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("UPDATE known_bans SET moderator_id = ? WHERE moderator_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("UPDATE known_bans SET target_id = ? WHERE target_id = ?", authorIds[row.name.lower()], row.id)
-			db.exec("DELETE FROM authors WHERE id = ?", row.id)
-		authorIds[row.name.lower()] = row.id
+			logger.logwrn('Partitioning is only supported on Postgres, ignoring it for %s' % db.dbType)
+	authorIds.maxsize = st.config['author_cache_size']
 
 	db.close()
\ No newline at end of file
@@ -77,6 +77,7 @@ def parse_url(raw_url: str):
 			username = url.path[3:].rstrip('/')
 			contentType = params.get('type', 'comment')
 			page = helpers.safeint(params.get('page'), 1)
+			before = helpers.safeint(params.get('before'), 0)
 			if '/' in username:
 				raise InvalidURL('Invalid user profile URL')
 			return {
@@ -84,6 +85,7 @@ def parse_url(raw_url: str):
 				'user': username,
 				'content': contentType,
 				'page': page,
+				'before': before,
 				'normalized_path': '/u/' + username + '?type=' + contentType
 			}
 		elif path == '/communities':
@@ -124,10 +126,13 @@ def parse_url(raw_url: str):
 				}
 			elif path == '/logs':
 				page = helpers.safeint(params.get('page'), 1)
+				before = helpers.safeint(params.get('before'), 0)
 				action = params.get('type', '*')
 				moderator = params.get('moderator', '*')
 				target = params.get('target', '*')
 				normalized_path = '/c/%s/logs?type=%s&moderator=%s&target=%s&page=%d' % (community, action, moderator, target, page)
+				if before:
+					normalized_path += '&before=%d' % before
 				return {
 					'type': 'modlog',
 					'community': community,
@@ -135,6 +140,7 @@ def parse_url(raw_url: str):
 					'moderator': moderator.strip() if moderator.strip() else '*',
 					'target': target.strip() if target.strip() else '*',
 					'page': page,
+					'before': before,
 					'normalized_path': normalized_path
 				}
 			elif path.startswith('/p/'):
@@ -171,6 +177,152 @@ def parse_url(raw_url: str):
 	
 
 
+#######################
+### Archive queries ###
+
+#Upper bound for keyset pagination cursors (largest bigint)
+MAX_ID = 2**63 - 1
+
+#Returns the (cursor, offset) to query with. Page numbers are still accepted for links without a cursor
+def get_page_cursor(before, page: int, limit: int):
+	if before:
+		return before, 0
+	return MAX_ID, max(0, page - 1) * limit
+
+ARCHIVED_POST_SELECT = """
+	SELECT
+		posts.*,
+		COALESCE(ban_status.is_banned, FALSE) AS is_banned,
+		authors.is_suspended,
+		authors.name AS author,
+		CASE
+			WHEN ban_status.nuked_at_ms IS NOT NULL AND ban_status.nuked_at_ms >= posts.created_ms THEN TRUE
+			ELSE FALSE
+		END is_nuked,
+		ban_status.banned_by,
+		ban_status.ban_reason
+	FROM posts
+	INNER JOIN authors ON authors.id = posts.author_id
+	LEFT OUTER JOIN ban_status ON ban_status.board_id = posts.board_id AND ban_status.author_id = posts.author_id
+"""
+
+ARCHIVED_COMMENT_SELECT = """
+	SELECT
+		comments.*,
+		COALESCE(ban_status.is_banned, FALSE) AS is_banned,
+		authors.is_suspended,
+		authors.name AS author,
+		CASE
+			WHEN ban_status.nuked_at_ms IS NOT NULL AND ban_status.nuked_at_ms >= comments.created_ms THEN TRUE
+			ELSE FALSE
+		END is_nuked,
+		ban_status.banned_by,
+		ban_status.ban_reason
+	FROM comments
+	INNER JOIN authors ON authors.id = comments.author_id
+	LEFT OUTER JOIN ban_status ON ban_status.board_id = comments.board_id AND ban_status.author_id = comments.author_id
+"""
+
+QUERY_POST_BY_ID = ARCHIVED_POST_SELECT + "WHERE posts.id = ?"
+QUERY_COMMENT_BY_ID = ARCHIVED_COMMENT_SELECT + "WHERE comments.id = ?"
+QUERY_COMMENTS_BY_POST = ARCHIVED_COMMENT_SELECT + "WHERE comments.post_id = ?"
+QUERY_PROFILE_POSTS = ARCHIVED_POST_SELECT + "WHERE posts.id <= ? AND posts.id >= ? AND posts.author_id = ?"
+QUERY_PROFILE_COMMENTS = ARCHIVED_COMMENT_SELECT + "WHERE comments.id <= ? AND comments.id >= ? AND comments.author_id = ?"
+QUERY_FEED_POSTS = ARCHIVED_POST_SELECT + "WHERE posts.id <= ? AND posts.id >= ? AND posts.board_id = ? LIMIT 50"
+
+QUERY_SUSPENDED_PROFILE_POSTS = """
+	SELECT
+		posts.*,
+		authors.name AS author,
+		boards.name AS community,
+		COALESCE(ban_status.is_banned, FALSE) AS is_banned,
+		TRUE AS is_suspended,
+		CASE
+			WHEN ban_status.nuked_at_ms IS NOT NULL AND ban_status.nuked_at_ms >= posts.created_ms THEN TRUE
+			ELSE FALSE
+		END is_nuked,
+		ban_status.banned_by,
+		ban_status.ban_reason
+	FROM posts
+	INNER JOIN authors ON authors.id = posts.author_id
+	INNER JOIN boards ON boards.id = posts.board_id
+	LEFT OUTER JOIN ban_status ON ban_status.board_id = posts.board_id AND ban_status.author_id = posts.author_id
+	WHERE posts.author_id = ? AND posts.id < ?
+	ORDER BY posts.id DESC
+	LIMIT ?
+	OFFSET ?
+"""
+
+QUERY_SUSPENDED_PROFILE_COMMENTS = """
+	SELECT
+		comments.*,
+		authors.name AS author,
+		boards.name AS community,
+		COALESCE(ban_status.is_banned, FALSE) AS is_banned,
+		TRUE AS is_suspended,
+		CASE
+			WHEN ban_status.nuked_at_ms IS NOT NULL AND ban_status.nuked_at_ms >= comments.created_ms THEN TRUE
+			ELSE FALSE
+		END is_nuked,
+		ban_status.banned_by,
+		ban_status.ban_reason
+	FROM comments
+	INNER JOIN authors ON authors.id = comments.author_id
+	INNER JOIN boards ON boards.id = comments.board_id
+	LEFT OUTER JOIN ban_status ON ban_status.board_id = comments.board_id AND ban_status.author_id = comments.author_id
+	WHERE comments.author_id = ? AND comments.id < ?
+	ORDER BY comments.id DESC
+	LIMIT ?
+	OFFSET ?
+"""
+
+QUERY_MODLOGS = """
+	SELECT
+		modlogs.created_ms,
+		moderators.name AS moderator,
+		targets.name AS target,
+		modlogs.type,
+		modlogs.description,
+		modlogs.post_id,
+		modlogs.comment_id
+	FROM modlogs
+	INNER JOIN authors AS moderators ON moderators.id = modlogs.moderator_id
+	INNER JOIN authors AS targets ON targets.id = modlogs.target_id
+	WHERE board_id = ? AND modlogs.created_ms < ? %s
+	ORDER BY modlogs.created_ms DESC
+	LIMIT ?
+	OFFSET ?
+"""
+
+
+#Queries checked by check_query_plans, with placeholder arguments
+PLANNED_QUERIES = {
+	'post_by_id': (QUERY_POST_BY_ID, (1,)),
+	'comment_by_id': (QUERY_COMMENT_BY_ID, (1,)),
+	'comments_by_post': (QUERY_COMMENTS_BY_POST, (1,)),
+	'profile_posts': (QUERY_PROFILE_POSTS, (2, 1, 1)),
+	'profile_comments': (QUERY_PROFILE_COMMENTS, (2, 1, 1)),
+	'feed_posts': (QUERY_FEED_POSTS, (2, 1, 1)),
+	'suspended_profile_posts': (QUERY_SUSPENDED_PROFILE_POSTS, (1, MAX_ID, 25, 0)),
+	'suspended_profile_comments': (QUERY_SUSPENDED_PROFILE_COMMENTS, (1, MAX_ID, 25, 0)),
+	'modlogs': (QUERY_MODLOGS % '', (1, MAX_ID, 25, 0)),
+	'modlogs_filtered': (QUERY_MODLOGS % 'AND modlogs.type = ? AND modlogs.moderator_id = ? AND modlogs.target_id = ?', (1, MAX_ID, 'ban', 1, 1, 25, 0)),
+}
+
+#Returns the names of archive queries whose plan contains a full table scan
+def check_query_plans(db: database.DBRequest):
+	failed = []
+	for name, (query, args) in PLANNED_QUERIES.items():
+		scans = database.find_table_scans(db, query, *args)
+		if scans:
+			logger.logerr('Query %s falls back to a table scan: %s' % (name, '; '.join(scans)))
+			failed.append(name)
+		else:
+			logger.log('Query %s uses indexes' % name)
+	return failed
+
+
+
 ###############
 ### Threads ###
 
@@ -223,7 +375,7 @@ def merge_post_with_archived(db: database.DBRequest, remote_post: dict, archived
 		if post['is_deleted'] or post['is_removed'] and 'moderation' not in remote_post:
 			post['author'] = archived_post.author
 			post['title'] = archived_post.title.strip()
-			post['raw_content'] = archived_post.raw_content.replace('\r\n', '\n')
+			post['raw_content'] = archive.get_raw_content(archived_post).replace('\r\n', '\n')
 			post['type'] = archived_post.type
 			post['link'] = archived_post.link
 			post['domain'] = urllib.parse.urlparse(archived_post.link).netloc
@@ -270,9 +422,9 @@ def merge_post_with_archived(db: database.DBRequest, remote_post: dict, archived
 
 
 	if post['is_deleted'] and not post['is_removed'] and not st.config['show_deleted']:
-		if st.config['purge_deleted'] and archived_post['raw_content'] != '':
+		if st.config['purge_deleted'] and archived_post and archive.has_raw_content(archived_post):
 			logger.logtrace('Purging deleted post %d' % post['id'])
-			db.exec("UPDATE posts SET raw_content = '', link = '', preview = '' WHERE id = ?", post['id'])
+			archive.purge_post(db, post['id'])
 		post['raw_content'] = post['link'] = post['domain'] = post['preview'] = post['domain'] = ''
 
 	return post
@@ -326,7 +478,7 @@ def merge_comment_with_archived(db: database.DBRequest, remote_comment: dict, ar
 	if archived_comment is not None:
 		if comment['is_deleted'] or comment['is_removed'] and 'moderation' not in remote_comment:
 			comment['author'] = archived_comment.author
-			comment['raw_content'] = archived_comment.raw_content.replace('\r\n', '\n')
+			comment['raw_content'] = archive.get_raw_content(archived_comment).replace('\r\n', '\n')
 		comment['ban'] = {
 			'is_banned': bool(archived_comment.is_banned),
 			'is_suspended': bool(archived_comment.is_suspended),
@@ -367,54 +519,19 @@ def merge_comment_with_archived(db: database.DBRequest, remote_comment: dict, ar
 		comment['raw_content'] = ''
 
 	if comment['is_deleted'] and not comment['is_removed'] and not st.config['show_deleted']:
-		if st.config['purge_deleted'] and archived_comment['raw_content'] != '':
+		if st.config['purge_deleted'] and archived_comment and archive.has_raw_content(archived_comment):
 			logger.logtrace('Purging deleted comment %d' % comment['id'])
-			db.exec("UPDATE comments SET raw_content = '' WHERE id = ?", comment['id'])
+			archive.purge_comment(db, comment['id'])
 		comment['raw_content'] = ''
 	return comment
 
 
 
 def fetch_thread(db: database.DBRequest, post_id: int):
-	archived_post = db.queryrow("""
-		SELECT
-			posts.*,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			authors.is_suspended,
-			authors.name AS author,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= posts.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM posts
-		INNER JOIN authors ON authors.id = posts.author_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = posts.author_id AND known_bans.board_id = posts.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE posts.id = ?
-	""", post_id)
-
-	query = """
-		SELECT
-			comments.*,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			authors.is_suspended,
-			authors.name AS author,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= comments.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM comments
-		INNER JOIN authors ON authors.id = comments.author_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = comments.author_id AND known_bans.board_id = comments.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE comments.post_id = ?
-	"""
+	archived_post = db.queryrow(QUERY_POST_BY_ID, post_id)
+
 	archivedCommentsById = {}
-	for archived_comment in db.query(query, post_id):
+	for archived_comment in db.query(QUERY_COMMENTS_BY_POST, post_id):
 		archivedCommentsById[archived_comment.id] = archived_comment
 
 	resp = scoredapi.apireq('GET', '/api/v2/post/post.json', {
@@ -463,7 +580,7 @@ def archived_post_to_dict(archived_post, is_removed=None, is_deleted=None, remov
 		'type': archived_post.type,
 		'link': archived_post.link,
 		'title': archived_post.title,
-		'raw_content': archived_post.raw_content,
+		'raw_content': archive.get_raw_content(archived_post),
 		'created': archived_post.created_ms,
 		'is_removed': is_removed if is_removed is not None else bool(archived_post.removal_source),
 		'is_deleted': is_deleted if is_deleted is not None else archived_post.known_deleted,
@@ -479,7 +596,7 @@ def archived_comment_to_dict(archived_comment, is_removed=False, is_deleted=Fals
 		'comment_parent_id': archived_comment.comment_parent_id,
 		'author': author if author is not None else archived_comment.author,
 		'community': community if community is not None else archived_comment.community,
-		'raw_content': archived_comment.raw_content,
+		'raw_content': archive.get_raw_content(archived_comment),
 		'created': archived_comment.created_ms,
 		'is_removed': is_removed if is_removed is not None else bool(archived_comment.removal_source),
 		'is_deleted': is_deleted if is_deleted is not None else archived_comment.known_deleted,
@@ -488,34 +605,11 @@ def archived_comment_to_dict(archived_comment, is_removed=False, is_deleted=Fals
 
 
 
-def _fetch_suspended_profile_posts(db: database.DBRequest, username: str, page: int):
-	author_id = database.get_author_id(db, username)
-	query = """
-		SELECT
-			posts.*,
-			authors.name AS author,
-			boards.name AS community,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			TRUE AS is_suspended,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= posts.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM posts
-		INNER JOIN authors ON authors.id = posts.author_id
-		INNER JOIN boards ON boards.id = posts.board_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = posts.author_id AND known_bans.board_id = posts.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE posts.author_id = ?
-		ORDER BY posts.id DESC
-		LIMIT ?
-		OFFSET ?
-	"""
+def _fetch_suspended_profile_posts(db: database.DBRequest, username: str, page: int, before_id=0):
+	author_id = database.get_author_id(db, username, allow_insert=False)
 	limit = scoredapi.ITEMS_PER_PAGE
-	offset = max(0, page - 1) * scoredapi.ITEMS_PER_PAGE
-	archived_posts = db.query(query, author_id, limit, offset)
+	before_id, offset = get_page_cursor(before_id, page, limit)
+	archived_posts = db.query(QUERY_SUSPENDED_PROFILE_POSTS, author_id, before_id, limit, offset)
 	simulated_posts = [
 		archived_post_to_dict(archived_post, is_removed=True, removal_source='nuke')
 		for archived_post in archived_posts
@@ -526,38 +620,16 @@ def _fetch_suspended_profile_posts(db: database.DBRequest, username: str, page:
 			merge_post_with_archived(db, post, archived_post)
 			for post, archived_post in zip(simulated_posts, archived_posts)
 		],
-		'has_more_entries': len(archived_posts) == limit
+		'has_more_entries': len(archived_posts) == limit,
+		'next_before': archived_posts[-1].id if archived_posts else None
 	}
 
 
-def _fetch_suspended_profile_comments(db: database.DBRequest, username: str, page: int):
-	author_id = database.get_author_id(db, username)
-	query = """
-		SELECT
-			comments.*,
-			authors.name AS author,
-			boards.name AS community,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			TRUE AS is_suspended,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= comments.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM comments
-		INNER JOIN authors ON authors.id = comments.author_id
-		INNER JOIN boards ON boards.id = comments.board_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = comments.author_id AND known_bans.board_id = comments.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE comments.author_id = ?
-		ORDER BY comments.id DESC
-		LIMIT ?
-		OFFSET ?
-	"""
+def _fetch_suspended_profile_comments(db: database.DBRequest, username: str, page: int, before_id=0):
+	author_id = database.get_author_id(db, username, allow_insert=False)
 	limit = scoredapi.ITEMS_PER_PAGE
-	offset = max(0, page - 1) * scoredapi.ITEMS_PER_PAGE
-	archived_comments = db.query(query, author_id, limit, offset)
+	before_id, offset = get_page_cursor(before_id, page, limit)
+	archived_comments = db.query(QUERY_SUSPENDED_PROFILE_COMMENTS, author_id, before_id, limit, offset)
 	simulated_comments = [
 		archived_comment_to_dict(archived_comment, is_removed=True, removal_source='nuke')
 		for archived_comment in archived_comments
@@ -568,11 +640,12 @@ def _fetch_suspended_profile_comments(db: database.DBRequest, username: str, pag
 			merge_comment_with_archived(db, comment, archived_comment)
 			for comment, archived_comment in zip(simulated_comments, archived_comments)
 		],
-		'has_more_entries': len(archived_comments) == limit
+		'has_more_entries': len(archived_comments) == limit,
+		'next_before': archived_comments[-1].id if archived_comments else None
 	}
 
 
-def fetch_profile_posts(db: database.DBRequest, username: str, page: int):
+def fetch_profile_posts(db: database.DBRequest, username: str, page: int, before_id=0):
 	isSuspended = False
 	isDeleted = False
 	resp = scoredapi.apireq('GET', '/api/v2/user/about.json', {
@@ -596,7 +669,7 @@ def fetch_profile_posts(db: database.DBRequest, username: str, page: int):
 
 	elif isSuspended:
 		archive.mark_user_suspended(db, username)
-		return _fetch_suspended_profile_posts(db, username, page)
+		return _fetch_suspended_profile_posts(db, username, page, before_id)
 
 	else:
 		resp = scoredapi.apireq('GET', '/api/v2/post/profile.json', {
@@ -608,29 +681,11 @@ def fetch_profile_posts(db: database.DBRequest, username: str, page: int):
 		if not resp['status']:
 			raise RequestFailed(resp['error'])
 		
-		query = """
-			SELECT
-				posts.*,
-				authors.name AS author,
-				COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-				authors.is_suspended,
-				CASE
-					WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= posts.created_ms THEN TRUE
-					ELSE FALSE
-				END is_nuked,
-				moderators.name AS banned_by,
-				known_bans.reason AS ban_reason
-			FROM posts
-			INNER JOIN authors ON authors.id = posts.author_id
-			LEFT OUTER JOIN known_bans ON known_bans.target_id = posts.author_id AND known_bans.board_id = posts.board_id
-			LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-			WHERE posts.id <= ? AND posts.id >= ? AND posts.author_id = ?
-		"""
 		archivedPostsById = {}
 		if resp['posts']:
 			firstId = resp['posts'][0]['id']
 			lastId = resp['posts'][-1]['id']
-			for archived_post in db.query(query, firstId, lastId, database.get_author_id(db, username)):
+			for archived_post in db.query(QUERY_PROFILE_POSTS, firstId, lastId, database.get_author_id(db, username, allow_insert=False)):
 				archivedPostsById[archived_post.id] = archived_post
 
 		return {
@@ -643,7 +698,7 @@ def fetch_profile_posts(db: database.DBRequest, username: str, page: int):
 		}
 
 
-def fetch_profile_comments(db: database.DBRequest, username: str, page: int):
+def fetch_profile_comments(db: database.DBRequest, username: str, page: int, before_id=0):
 	isSuspended = False
 	isDeleted = False
 	resp = scoredapi.apireq('GET', '/api/v2/user/about.json', {
@@ -667,7 +722,7 @@ def fetch_profile_comments(db: database.DBRequest, username: str, page: int):
 
 	elif isSuspended:
 		archive.mark_user_suspended(db, username)
-		return _fetch_suspended_profile_comments(db, username, page)
+		return _fetch_suspended_profile_comments(db, username, page, before_id)
 
 	else:
 		resp = scoredapi.apireq('GET', '/api/v2/comment/profile.json', {
@@ -679,29 +734,11 @@ def fetch_profile_comments(db: database.DBRequest, username: str, page: int):
 		if not resp['status']:
 			raise RequestFailed(resp['error'])
 		
-		query = """
-			SELECT
-				comments.*,
-				COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-				authors.is_suspended,
-				authors.name AS author,
-				CASE
-					WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= comments.created_ms THEN TRUE
-					ELSE FALSE
-				END is_nuked,
-				moderators.name AS banned_by,
-				known_bans.reason AS ban_reason
-			FROM comments
-			INNER JOIN authors ON authors.id = comments.author_id
-			LEFT OUTER JOIN known_bans ON known_bans.target_id = comments.author_id AND known_bans.board_id = comments.board_id
-			LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-			WHERE comments.id <= ? AND comments.id >= ? AND comments.author_id = ?
-		"""
 		archivedCommentsById = {}
 		if resp['comments']:
 			firstId = resp['comments'][0]['id']
 			lastId = resp['comments'][-1]['id']
-			for archived_comment in db.query(query, firstId, lastId, database.get_author_id(db, username)):
+			for archived_comment in db.query(QUERY_PROFILE_COMMENTS, firstId, lastId, database.get_author_id(db, username, allow_insert=False)):
 				archivedCommentsById[archived_comment.id] = archived_comment
 
 		return {
@@ -740,44 +777,6 @@ def fetch_profile_removedcontent(db: database.DBRequest, username: str, from_pos
 		archive.mark_user_suspended(db, username)
 		raise RequestFailed('User account suspended.')
 
-	queryPost = """
-		SELECT
-			posts.*,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			authors.is_suspended,
-			authors.name AS author,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= posts.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM posts
-		INNER JOIN authors ON authors.id = posts.author_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = posts.author_id AND known_bans.board_id = posts.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE posts.id = ?
-	"""
-
-	queryComment = """
-		SELECT
-			comments.*,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			authors.is_suspended,
-			authors.name AS author,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= comments.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM comments
-		INNER JOIN authors ON authors.id = comments.author_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = comments.author_id AND known_bans.board_id = comments.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE comments.id = ?
-	"""
-
 	removed = []
 	reqCount = 0
 	has_more_entries = True
@@ -797,12 +796,12 @@ def fetch_profile_removedcontent(db: database.DBRequest, username: str, from_pos
 				if 'title' in content:
 					from_post += 1
 					if content['is_removed']:
-						archived_post = db.queryrow(queryPost, content['id'])
+						archived_post = db.queryrow(QUERY_POST_BY_ID, content['id'])
 						removed.append(merge_post_with_archived(db, content, archived_post))
 				else:
 					from_comment += 1
 					if content['is_removed']:
-						archived_comment = db.queryrow(queryComment, content['id'])
+						archived_comment = db.queryrow(QUERY_COMMENT_BY_ID, content['id'])
 						removed.append(merge_comment_with_archived(db, content, archived_comment))
 			if not resp['has_more_entries']:
 				has_more_entries = False
@@ -821,7 +820,7 @@ def fetch_profile_removedcontent(db: database.DBRequest, username: str, from_pos
 
 def fetch_new_feed(db: database.DBRequest, community: str, from_uuid: str = None):
 	modlog_status = 'none'
-	board_id = database.get_board_id(db, community)
+	board_id = database.get_board_id(db, community, allow_insert=False)
 	if community in st.ingest:
 		modlog_status = 'full' if st.ingest[community]['modlogs'] else 'bans' if st.ingest[community]['banlogs'] else 'none'
 	resp = scoredapi.apireq('GET', '/api/v2/post/newv2.json', {
@@ -844,28 +843,8 @@ def fetch_new_feed(db: database.DBRequest, community: str, from_uuid: str = None
 	for post in resp['posts']:
 		postsById[post['id']] = post
 
-	query = """
-		SELECT
-			posts.*,
-			COALESCE(known_bans.permabanned, FALSE) AS is_banned,
-			authors.is_suspended,
-			authors.name AS author,
-			CASE
-				WHEN known_bans.nuked_at_ms IS NOT NULL AND known_bans.nuked_at_ms >= posts.created_ms THEN TRUE
-				ELSE FALSE
-			END is_nuked,
-			moderators.name AS banned_by,
-			known_bans.reason AS ban_reason
-		FROM posts
-		INNER JOIN authors ON authors.id = posts.author_id
-		LEFT OUTER JOIN known_bans ON known_bans.target_id = posts.author_id AND known_bans.board_id = posts.board_id
-		LEFT OUTER JOIN authors AS moderators ON moderators.id = known_bans.moderator_id
-		WHERE posts.id <= ? AND posts.id >= ? AND posts.board_id = ?
-		LIMIT 50
-	"""
-
 	archivedById = {}
-	for archived_post in db.query(query, highestId, lowestId, board_id):
+	for archived_post in db.query(QUERY_FEED_POSTS, highestId, lowestId, board_id):
 		archivedById[archived_post.id] = archived_post
 
 	for id in postsById:
@@ -890,7 +869,7 @@ def fetch_new_feed(db: database.DBRequest, community: str, from_uuid: str = None
 			if resp['status']:
 				post = resp['posts'][0]
 				if post['is_deleted'] and not archived_post.known_deleted:
-					db.exec("UPDATE posts SET known_deleted = TRUE WHERE id = ?", archived_post.id)
+					archive.mark_post_deleted(db, archived_post.id)
 					logger.logtrace('Marked post %d as deleted' % archived_post.id)
 				elif post['is_removed']:
 					post = merge_post_with_archived(db, post, archived_post)
@@ -904,7 +883,7 @@ def fetch_new_feed(db: database.DBRequest, community: str, from_uuid: str = None
 
 
 BLACKLISTED_MODS = ['', 'C', 'Perun', 'GlobalFilter', 'CommunityFilter']
-def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str, moderator: str, target: str):
+def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str, moderator: str, target: str, before_ms=0):
 	board_id = database.get_board_id(db, community, allow_insert=False)
 	if not moderator or moderator == '*':
 		moderator_id = 0
@@ -914,8 +893,7 @@ def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str
 		target_id = 0
 	else:
 		target_id = database.get_author_id(db, target, allow_insert=False)
-	q = "SELECT DISTINCT authors.name FROM modlogs INNER JOIN authors ON modlogs.moderator_id = authors.id  WHERE board_id = ?"
-	modsInLog = [row.name for row in db.query(q, board_id)]
+	modsInLog = list(archive.get_moderator_roster(db, board_id).values())
 	if len(modsInLog) == 1 and modsInLog[0] == '':
 		moderators = None
 	else:
@@ -925,7 +903,10 @@ def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str
 			'filters': ['GlobalFilter', 'CommunityFilter']
 		}
 
-	args = [board_id]
+	LIMIT = 25
+	before_ms, offset = get_page_cursor(before_ms, page, LIMIT)
+
+	args = [board_id, before_ms]
 	select = []
 	if action and action != '*':
 		select.append('modlogs.type = ?')
@@ -937,27 +918,10 @@ def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str
 		select.append('modlogs.target_id = ?')
 		args.append(target_id)
 	
-	q = """
-		SELECT
-			modlogs.created_ms,
-			moderators.name AS moderator,
-			targets.name AS target,
-			modlogs.type,
-			modlogs.description,
-			modlogs.post_id,
-			modlogs.comment_id
-		FROM modlogs
-		INNER JOIN authors AS moderators ON moderators.id = modlogs.moderator_id
-		INNER JOIN authors AS targets ON targets.id = modlogs.target_id
-		WHERE board_id = ? %s
-		ORDER BY modlogs.created_ms DESC
-		LIMIT ?
-		OFFSET ?
-	""" % ('AND ' + ' AND '.join(select) if select else '')
+	q = QUERY_MODLOGS % ('AND ' + ' AND '.join(select) if select else '')
 
-	LIMIT = 25
 	args.append(LIMIT)
-	args.append((page - 1) * LIMIT)
+	args.append(offset)
 	
 	rows = db.query(q, *args)
 	return {
@@ -976,5 +940,6 @@ def fetch_modlogs(db: database.DBRequest, community: str, page: int, action: str
 			for row in rows
 		],
 		'moderators': moderators,
-		'has_more_entries': len(rows) == 25
+		'has_more_entries': len(rows) == LIMIT,
+		'next_before': rows[-1].created_ms if rows else None
 	}
\ No newline at end of file
@@ -184,7 +184,7 @@ def ingest_missing_post(db: database.DBRequest, post_id: int):
 			logger.log_traceback()
 		else:
 			if recovered_from_scrape:
-				db.exec("UPDATE posts SET recovery_method = 'scrape' WHERE id = ?", post_id)
+				archive.set_recovery_method(db, post_id, 'scrape')
 
 
 def get_last_known_postid() -> int:
@@ -215,13 +215,11 @@ def ingest_post_and_comments(db: database.DBRequest, post_id: int):
 			logger.log_traceback()
 		else:
 			if recovered_from_scrape:
-				db.exec("UPDATE posts SET recovery_method = 'scrape' WHERE id = ?", post_id)
-		comments = resp['comments']
-		for comment in comments:
-			try:
-				archive.add_comment(db, comment)
-			except Exception:
-				logger.log_traceback()
+				archive.set_recovery_method(db, post_id, 'scrape')
+		try:
+			archive.add_comments(db, resp['comments'])
+		except Exception:
+			logger.log_traceback()
 
 
 def ingest_complete_modlog(db: database.DBRequest, community: str):
@@ -277,6 +275,7 @@ def ingest_global_posts(db: database.DBRequest):
 			'from': fromId
 		})
 		if resp['status'] and len(resp['posts']) > 0:
+			pagePosts = []
 			for post in resp['posts']:
 				if post['id'] <= finalId:
 					end = True
@@ -290,10 +289,11 @@ def ingest_global_posts(db: database.DBRequest):
 				idsFound.add(post['id'])
 				previousId = post['id']
 				postCount += 1
-				try:
-					archive.add_post(db, post)
-				except Exception:
-					logger.log_traceback()
+				pagePosts.append(post)
+			try:
+				archive.add_posts(db, pagePosts)
+			except Exception:
+				logger.log_traceback()
 			fromId = resp['posts'][-1]['uuid']
 			if end or not resp['has_more_entries']:
 				break
@@ -334,6 +334,7 @@ def ingest_community_posts(db: database.DBRequest, community: str):
 			'from': fromId
 		})
 		if resp['status'] and len(resp['posts']) > 0:
+			pagePosts = []
 			for post in resp['posts']:
 				if post['id'] <= finalId:
 					end = True
@@ -346,10 +347,11 @@ def ingest_community_posts(db: database.DBRequest, community: str):
 					continue
 				previousId = post['id']
 				postCount += 1
-				try:
-					archive.add_post(db, post)
-				except Exception:
-					logger.log_traceback()
+				pagePosts.append(post)
+			try:
+				archive.add_posts(db, pagePosts)
+			except Exception:
+				logger.log_traceback()
 			fromId = resp['posts'][-1]['uuid']
 			if end or not resp['has_more_entries']:
 				break
@@ -386,6 +388,7 @@ def ingest_community_comments(db: database.DBRequest, community: str):
 		if resp['status'] and len(resp['comments']) > 0:
 			if not newInterval:
 				newInterval = calculate_new_interval(resp['comments'])
+			pageComments = []
 			for comment in resp['comments']:
 				if comment['id'] <= finalId:
 					end = True
@@ -396,10 +399,11 @@ def ingest_community_comments(db: database.DBRequest, community: str):
 					firstId = comment['id']
 				previousId = comment['id']
 				commentCount += 1
-				try:
-					archive.add_comment(db, comment)
-				except Exception:
-					logger.log_traceback()
+				pageComments.append(comment)
+			try:
+				archive.add_comments(db, pageComments)
+			except Exception:
+				logger.log_traceback()
 			if end or not resp['has_more_entries']:
 				break
 		else:
@@ -531,6 +535,7 @@ def thread_ingest():
 			try:
 				if community == 'global':
 					ingest_global_posts(db)
+					database.ensure_partitions(db)
 				else:
 					ingest_community_comments(db, community)
 					if st.ingest[community]['modlogs']:
@@ -1,14 +1,17 @@
 import random
 import time
 import json
+import threading
 
 import eventlet
 import requests
+import requests.adapters
 import base62
 from bs4 import BeautifulSoup
 
 from utils import helpers
 from utils import logger
+from utils import cache
 
 import state as st
 import database
@@ -47,43 +50,195 @@ def get_uagent():
 	uagent = st.config['scored_api_useragent']
 	if st.config['scored_api_useragent_appendver']:
 		uagent += ' ' + st.VERSION
+	return uagent
 
 
-respCache = {}
+respCache = None
+
+def get_resp_cache() -> cache.TTLCache:
+	global respCache
+	if respCache is None:
+		respCache = cache.TTLCache(st.config['cache_max_mb'] * 2**20)
+	return respCache
+
+def _cache_key(endpoint: str, params: dict):
+	return endpoint + '?' + '&'.join(str(k) + '=' + str(v) for k, v in params.items())
+
+diskCache = None
+
+def get_disk_cache() -> cache.DiskCache:
+	global diskCache
+	if diskCache is None and st.config['disk_cache']:
+		diskCache = cache.DiskCache(st.config['disk_cache_path'], st.config['disk_cache_max_mb'] * 2**20, database.run_sqlite)
+	return diskCache
 
 def get_resp_from_cache(endpoint: str, params: dict):
-	curTime = time.time()
-	url = endpoint + '?' + '&'.join(str(k) + '=' + str(v) for k, v in params.items())
-	for key in list(respCache.keys()):
-		if curTime > respCache[key]['expires']:
-			try:
-				del respCache[key]
-			except KeyError:
-				pass
-	if url in respCache:
-		logger.logdebug('[Scored API] Got resp from cache (expires in %ss)' % int(respCache[url]['expires'] - curTime))
-		return respCache[url]['resp']
-	else:
-		return None
+	url = _cache_key(endpoint, params)
+	resp = get_resp_cache().get(url)
+	if resp is not None:
+		logger.logdebug('[Scored API] Got resp from cache (expires in %ss)' % int(respCache.expires_in(url)))
+		return resp
+	if get_disk_cache():
+		data, ttl = diskCache.get(url)
+		if data is not None:
+			resp = json.loads(data)
+			logger.logdebug('[Scored API] Got resp from disk cache (expires in %ss)' % int(ttl))
+			respCache.put(url, resp, ttl, len(url) + len(data))
+			return resp
+	return None
 
 def add_resp_to_cache(endpoint: str, params: dict, resp: dict, cache_ttl: int):
-	url = endpoint + '?' + '&'.join(str(k) + '=' + str(v) for k, v in params.items())
-	logger.logtrace('Added to cache (ttl=%d): %s' % (cache_ttl, url))
-	respCache[url] = {
-		'expires': time.time() + cache_ttl,
-		'resp': resp
-	}
+	url = _cache_key(endpoint, params)
+	data = json.dumps(resp)
+	#The serialized length is a close enough stand-in for the memory a response takes
+	size = len(url) + len(data)
+	logger.logtrace('Added to cache (ttl=%d, %d bytes): %s' % (cache_ttl, size, url))
+	get_resp_cache().put(url, resp, cache_ttl, size)
+	if get_disk_cache():
+		diskCache.put(url, data.encode(), cache_ttl)
+
+def thread_compact_cache():
+	while True:
+		time.sleep(st.config['disk_cache_compact_interval'])
+		tStart = time.time_ns()
+		removed = get_disk_cache().compact()
+		ms = (time.time_ns() - tStart) // 10**6
+		logger.logdebug('[Scored API] Compacted disk cache, %d entries removed in %d ms' % (removed, ms))
+
+
+
+#####################
+### HTTP sessions ###
+
+httpSession = None
+httpSessionLock = threading.Lock()
+
+#Shared session keeping connections alive, with one pool per host for the API and each scraped domain
+def get_session() -> requests.Session:
+	global httpSession
+	if httpSession is None:
+		with httpSessionLock:
+			if httpSession is None:
+				session = requests.Session()
+				adapter = requests.adapters.HTTPAdapter(
+					pool_connections=st.config['http_pool_hosts'],
+					pool_maxsize=st.config['http_pool_size']
+				)
+				session.mount('https://', adapter)
+				session.mount('http://', adapter)
+				httpSession = session
+	return httpSession
+
+def get_timeout(read_timeout):
+	return (st.config['http_connect_timeout'], read_timeout)
+
+#Connections opened and requests sent per host; the difference is the number of reused connections
+def get_http_stats() -> dict:
+	stats = {}
+	if httpSession is None:
+		return stats
+	for adapter in set(httpSession.adapters.values()):
+		pools = adapter.poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool is None:
+				continue
+			host = stats.setdefault(pool.host, {'connections': 0, 'requests': 0, 'reused': 0})
+			host['connections'] += pool.num_connections
+			host['requests'] += pool.num_requests
+			host['reused'] += max(0, pool.num_requests - pool.num_connections)
+	return stats
+
+
+
+#######################
+### Upstream pacing ###
+
+#Process-wide token bucket for upstream requests. Halves its rate when throttled and ramps back up on success
+class Pacer:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.rate = st.config['pacer_rate']
+		self.tokens = st.config['pacer_burst']
+		self.updated = time.monotonic()
+		self.blockedUntil = 0
+		self.stats = {
+			'requests': 0,
+			'throttled': 0,
+			'retries': 0,
+			'rejected': 0,
+			'wait_ms_total': 0
+		}
+
+	def _refill(self, now):
+		self.tokens = min(st.config['pacer_burst'], self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	#Waits for a token. Returns False right away, without queueing, if that would take longer than pacer_max_wait_ms
+	def acquire(self) -> bool:
+		with self.lock:
+			now = time.monotonic()
+			self._refill(now)
+			wait = max(0, (1 - self.tokens) / self.rate, self.blockedUntil - now)
+			if wait * 1000 > st.config['pacer_max_wait_ms']:
+				self.stats['rejected'] += 1
+				return False
+			#Taking the token up front queues concurrent callers behind each other
+			self.tokens -= 1
+			self.stats['requests'] += 1
+			self.stats['wait_ms_total'] += wait * 1000
+		if wait > 0:
+			logger.logtrace('Upstream pacing: waiting %d ms' % (wait * 1000))
+			eventlet.sleep(wait)
+		return True
+
+	def on_success(self):
+		with self.lock:
+			self.rate = min(st.config['pacer_max_rate'], self.rate + st.config['pacer_increase'])
+
+	def on_throttle(self, retry_after=0):
+		with self.lock:
+			now = time.monotonic()
+			self._refill(now)
+			self.rate = max(st.config['pacer_min_rate'], self.rate / 2)
+			self.stats['throttled'] += 1
+			if retry_after:
+				self.blockedUntil = max(self.blockedUntil, now + retry_after)
+		logger.logwrn('[Scored API] throttled, pacing at %.2f requests/s' % self.rate)
 
+	def get_stats(self):
+		stats = self.stats.copy()
+		stats['rate'] = round(self.rate, 2)
+		stats['blocked_for'] = round(max(0, self.blockedUntil - time.monotonic()), 1)
+		return stats
 
 
-def api_cooldown():
-	ms = random.randrange(st.config['request_cooldown_min_ms'], st.config['request_cooldown_max_ms'])
-	logger.logtrace('API cooldown: %d ms' % ms)
+pacer = None
+
+def get_pacer() -> Pacer:
+	global pacer
+	if pacer is None:
+		pacer = Pacer()
+	return pacer
+
+def get_retry_after(resp) -> float:
+	try:
+		return max(0, float(resp.headers.get('Retry-After', 0)))
+	except ValueError:
+		#HTTP dates are not worth parsing here; the backoff still applies
+		return 0
+
+#Sleeps for a jittered exponential delay, and at least as long as the server asked for
+def retry_backoff(attempt: int, retry_after=0):
+	cap = min(st.config['retry_backoff_max_ms'], st.config['retry_backoff_base_ms'] * 2 ** (attempt - 1))
+	ms = max(retry_after * 1000, random.uniform(cap / 2, cap))
+	logger.logtrace('[Scored API] retrying in %d ms' % ms)
+	get_pacer().stats['retries'] += 1
 	eventlet.sleep(ms / 1000)
 
 
 def _api_request(method: str, endpoint: str, params: dict, attempt: int):
-	logger.logdebug('[Scored API] attempt %d/3' % attempt)
+	logger.logdebug('[Scored API] attempt %d/%d' % (attempt, st.config['request_max_attempts']))
 	url = 'https://scored.co/' + endpoint.lstrip('/')
 	headers = {
 		'User-Agent': get_uagent()
@@ -91,15 +246,38 @@ def _api_request(method: str, endpoint: str, params: dict, attempt: int):
 	if st.config['scored_api_key'] and st.config['scored_api_secret']:
 		headers['X-Api-Key'] = st.config['scored_api_key']
 		headers['X-Api-Secret'] = st.config['scored_api_secret']
+	timeout = get_timeout(st.config['http_api_timeout'])
 	if method.lower() == 'get':
-		resp = requests.get(url, headers=headers, params=params, timeout=7)
+		resp = get_session().get(url, headers=headers, params=params, timeout=timeout)
 	elif method.lower() == 'post':
-		resp = requests.post(url, headers=headers, data=params, timeout=7)
+		resp = get_session().post(url, headers=headers, data=params, timeout=timeout)
 	else:
 		raise ValueError('Invalid method')
 	return resp
 
 
+class _Flight:
+	def __init__(self):
+		self.done = threading.Event()
+		self.resp = {
+			'status': False,
+			'error': 'Failed'
+		}
+
+
+inflight = {}
+inflightLock = threading.Lock()
+coalesceStats = {
+	'upstream': 0,
+	'coalesced': 0
+}
+
+def get_coalesce_stats() -> dict:
+	stats = coalesceStats.copy()
+	stats['in_flight'] = len(inflight)
+	return stats
+
+
 def apireq(method: str, endpoint: str, params: dict, cache_ttl=0):
 	logger.logdebug('[Scored API] request: %s %s (cache_ttl=%d)' % (method, endpoint, cache_ttl))
 	logger.logtrace('Params: %s' % params)
@@ -107,57 +285,104 @@ def apireq(method: str, endpoint: str, params: dict, cache_ttl=0):
 		resp = get_resp_from_cache(endpoint, params)
 		if resp is not None:
 			return resp
-	attempt = 1
-	while attempt <= 3:
+	if method.lower() != 'get':
+		return _apireq_upstream(method, endpoint, params, cache_ttl)
+
+	#Identical GETs already on their way upstream share that request instead of sending their own
+	key = method.upper() + ' ' + _cache_key(endpoint, params)
+	with inflightLock:
+		flight = inflight.get(key)
+		leader = flight is None
+		if leader:
+			flight = inflight[key] = _Flight()
+	if not leader:
+		coalesceStats['coalesced'] += 1
+		logger.logdebug('[Scored API] Waiting for in-flight request: %s' % key)
+		flight.done.wait()
+		return flight.resp
+	coalesceStats['upstream'] += 1
+	try:
+		flight.resp = _apireq_upstream(method, endpoint, params, cache_ttl)
+	finally:
+		with inflightLock:
+			del inflight[key]
+		flight.done.set()
+	return flight.resp
+
+
+def _apireq_upstream(method: str, endpoint: str, params: dict, cache_ttl: int):
+	maxAttempts = st.config['request_max_attempts']
+	for attempt in range(1, maxAttempts + 1):
+		if not get_pacer().acquire():
+			logger.logwrn('[Scored API] too many requests queued upstream, giving up')
+			return {
+				'status': False,
+				'error': 'Rate limited'
+			}
 		t_ms_start = time.time_ns() // 10**6
 		try:
 			resp = _api_request(method, endpoint, params, attempt)
 		except Exception as e:
 			logger.logerr('[Scored API] exception - %s: %s' % (e.__class__.__name__, e))
+			retryAfter = 0
 		else:
-			logger.logtrace('[Scored API] returned data')
-			try:
-				jsonResp = resp.json()
-			except Exception:
+			if resp.status_code == 429 or resp.status_code >= 500:
 				logger.logerr('[Scored API] returned code %d' % resp.status_code)
-				return {
-					'status': False,
-					'error': 'Failed - status %d' % resp.status_code 
-				}
+				retryAfter = get_retry_after(resp)
+				get_pacer().on_throttle(retryAfter)
 			else:
-				if not jsonResp['status']:
-					logger.logerr('[Scored API] error response - %s' % jsonResp['error'])
-				if cache_ttl and st.config['caching']:
-					add_resp_to_cache(endpoint, params, jsonResp, cache_ttl)
-				return jsonResp
+				get_pacer().on_success()
+				logger.logtrace('[Scored API] returned data')
+				try:
+					jsonResp = resp.json()
+				except Exception:
+					logger.logerr('[Scored API] returned code %d' % resp.status_code)
+					return {
+						'status': False,
+						'error': 'Failed - status %d' % resp.status_code 
+					}
+				else:
+					if not jsonResp['status']:
+						logger.logerr('[Scored API] error response - %s' % jsonResp['error'])
+					if cache_ttl and st.config['caching']:
+						add_resp_to_cache(endpoint, params, jsonResp, cache_ttl)
+					return jsonResp
 		finally:
-			attempt += 1
 			t_ms_diff = time.time_ns() // 10**6 - t_ms_start
 			logger.logtrace('[Scored API] request finished in %d ms' % t_ms_diff)
-			api_cooldown()
-	else:
-		logger.logerr('[Scored API] all attempts failed')
-		return {
-			'status': False,
-			'error': 'Failed'
-		}
+		if attempt < maxAttempts and retryAfter * 1000 > st.config['pacer_max_wait_ms']:
+			logger.logwrn('[Scored API] asked to retry after %d s, giving up' % retryAfter)
+			break
+		if attempt < maxAttempts:
+			retry_backoff(attempt, retryAfter)
+	logger.logerr('[Scored API] all attempts failed')
+	return {
+		'status': False,
+		'error': 'Failed'
+	}
 	
 
 def scrape_page(url: str, params={}, selector='html'):
 	logger.logdebug('[Scraping] request: GET %s -> %s' % (url, selector))
+	if not get_pacer().acquire():
+		logger.logwrn('[Scraping] too many requests queued upstream, giving up')
+		return None
 	t_ms_start = time.time_ns() // 10**6
 	try:
-		resp = requests.get(url, params=params, headers={
+		resp = get_session().get(url, params=params, headers={
 			'User-Agent': get_uagent()
-		}, timeout=10)
+		}, timeout=get_timeout(st.config['http_scrape_timeout']))
 	except Exception as e:
 		logger.logerr('[Scraping] exception - %s: %s' % (e.__class__.__name__, e))
 		return None
 	finally:
 		t_ms_diff = time.time_ns() // 10**6 - t_ms_start
 		logger.logtrace('[Scraping] request finished in %d ms' % t_ms_diff)
+	if resp.status_code == 429 or resp.status_code >= 500:
+		get_pacer().on_throttle(get_retry_after(resp))
+	else:
+		get_pacer().on_success()
 	soup = BeautifulSoup(resp.content, 'html.parser')
-	api_cooldown()
 	return soup.select_one(selector)
 
 
@@ -1,6 +1,7 @@
 from . import console
 from . import logger
 from . import helpers
+from . import cache
 
 PRINT_LOG = True
 COLORPRINT = True
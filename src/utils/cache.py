@@ -0,0 +1,253 @@
+import os
+import time
+import zlib
+import heapq
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+#Dict-like cache holding at most `maxsize` entries, evicting the least recently used one
+class LRUCache:
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default=None):
+		with self.lock:
+			try:
+				value = self.items[key]
+			except KeyError:
+				self.misses += 1
+				return default
+			self.items.move_to_end(key)
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.items[key] = value
+			self.items.move_to_end(key)
+			while len(self.items) > self.maxsize:
+				self.items.popitem(last=False)
+				self.evictions += 1
+
+	def discard(self, key):
+		with self.lock:
+			self.items.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def __len__(self):
+		return len(self.items)
+
+	def get_stats(self):
+		return {
+			'entries': len(self.items),
+			'maxsize': self.maxsize,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions
+		}
+
+
+#LRU cache whose entries also expire, bounded by the approximate total size of the stored values
+class TTLCache:
+	def __init__(self, max_bytes):
+		self.maxBytes = max_bytes
+		self.items = OrderedDict()
+		self.expiries = []
+		self.bytes = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+	def _remove(self, key):
+		value, expires, size = self.items.pop(key)
+		self.bytes -= size
+
+	def _expire(self, now):
+		while self.expiries and self.expiries[0][0] <= now:
+			expires, key = heapq.heappop(self.expiries)
+			entry = self.items.get(key)
+			#Replaced entries leave their old expiry behind in the heap
+			if entry is not None and entry[1] == expires:
+				self._remove(key)
+				self.expirations += 1
+
+	def get(self, key, default=None):
+		with self.lock:
+			self._expire(time.time())
+			entry = self.items.get(key)
+			if entry is None:
+				self.misses += 1
+				return default
+			self.items.move_to_end(key)
+			self.hits += 1
+			return entry[0]
+
+	def put(self, key, value, ttl, size):
+		with self.lock:
+			now = time.time()
+			self._expire(now)
+			if key in self.items:
+				self._remove(key)
+			if size > self.maxBytes:
+				return
+			expires = now + ttl
+			self.items[key] = (value, expires, size)
+			self.bytes += size
+			heapq.heappush(self.expiries, (expires, key))
+			while self.bytes > self.maxBytes:
+				self._remove(next(iter(self.items)))
+				self.evictions += 1
+			if len(self.expiries) > 2 * len(self.items) + 64:
+				self.expiries = [(entry[1], k) for k, entry in self.items.items()]
+				heapq.heapify(self.expiries)
+
+	def expires_in(self, key):
+		entry = self.items.get(key)
+		return entry[1] - time.time() if entry else 0
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+			self.expiries.clear()
+			self.bytes = 0
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def __len__(self):
+		return len(self.items)
+
+	def get_stats(self):
+		return {
+			'entries': len(self.items),
+			'bytes': self.bytes,
+			'max_bytes': self.maxBytes,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'expirations': self.expirations
+		}
+
+
+#Expiring key/value store in its own SQLite file, keeping values zlib-compressed
+#Rows removed per statement while compacting, so the lock is never held for long
+DISK_CACHE_COMPACT_CHUNK = 500
+
+class DiskCache:
+	#`offload` runs each blocking SQLite call, e.g. on a thread pool so it does not stall the event loop
+	def __init__(self, path, max_bytes, offload=None):
+		self.maxBytes = max_bytes
+		self.offload = offload or (lambda func, *args: func(*args))
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.removed = 0
+		os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+		self.con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self.con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+		self.con.execute("PRAGMA journal_mode = WAL")
+		self.con.execute("PRAGMA synchronous = NORMAL")
+		self.con.execute("CREATE TABLE IF NOT EXISTS entries (key text PRIMARY KEY, expires real, size integer, value blob)")
+		self.con.execute("CREATE INDEX IF NOT EXISTS idx_entries_expires ON entries (expires)")
+
+	def _fetchone(self, query, args=()):
+		return self.con.execute(query, args).fetchone()
+
+	def _fetchall(self, query, args=()):
+		return self.con.execute(query, args).fetchall()
+
+	def _exec(self, query, args=()):
+		return self.con.execute(query, args).rowcount
+
+	def _delete_rowids(self, rowids):
+		return self.con.executemany("DELETE FROM entries WHERE rowid = ?", [(rowid,) for rowid in rowids]).rowcount
+
+	#Returns (value, seconds left) or (None, 0)
+	def get(self, key):
+		with self.lock:
+			row = self.offload(self._fetchone, "SELECT value, expires FROM entries WHERE key = ? AND expires > ?", (key, time.time()))
+			if row is None:
+				self.misses += 1
+				return None, 0
+			self.hits += 1
+		return zlib.decompress(row[0]), row[1] - time.time()
+
+	def put(self, key, value: bytes, ttl):
+		blob = zlib.compress(value)
+		with self.lock:
+			self.offload(
+				self._exec,
+				"INSERT OR REPLACE INTO entries (key, expires, size, value) VALUES (?, ?, ?, ?)",
+				(key, time.time() + ttl, len(blob), blob)
+			)
+
+	#Drops expired entries, then the ones closest to expiring until the file fits its budget.
+	#Works in chunks and releases the lock between them so lookups are not held up
+	def compact(self):
+		removed = 0
+		now = time.time()
+		while True:
+			with self.lock:
+				count = self.offload(
+					self._exec,
+					"DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries WHERE expires <= ? LIMIT ?)",
+					(now, DISK_CACHE_COMPACT_CHUNK)
+				)
+			removed += count
+			if count < DISK_CACHE_COMPACT_CHUNK:
+				break
+			time.sleep(0)
+		with self.lock:
+			total = self.offload(self._fetchone, "SELECT COALESCE(SUM(size), 0) FROM entries")[0]
+		while total > self.maxBytes:
+			with self.lock:
+				rows = self.offload(self._fetchall, "SELECT rowid, size FROM entries ORDER BY expires LIMIT ?", (DISK_CACHE_COMPACT_CHUNK,))
+				rowids = []
+				for rowid, size in rows:
+					if total <= self.maxBytes:
+						break
+					rowids.append(rowid)
+					total -= size
+				if rowids:
+					self.offload(self._delete_rowids, rowids)
+			removed += len(rowids)
+			if len(rows) < DISK_CACHE_COMPACT_CHUNK:
+				break
+			time.sleep(0)
+		while True:
+			with self.lock:
+				self.offload(self._fetchall, "PRAGMA incremental_vacuum(%d)" % DISK_CACHE_COMPACT_CHUNK)
+				free = self.offload(self._fetchone, "PRAGMA freelist_count")[0]
+			if not free:
+				break
+			time.sleep(0)
+		with self.lock:
+			self.removed += removed
+		return removed
+
+	def get_stats(self):
+		with self.lock:
+			entries, size = self.offload(self._fetchone, "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+		return {
+			'entries': entries,
+			'bytes': size,
+			'max_bytes': self.maxBytes,
+			'hits': self.hits,
+			'misses': self.misses,
+			'removed': self.removed
+		}
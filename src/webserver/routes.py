@@ -24,7 +24,24 @@ def admin_dashboard():
 	if wapp.is_admin():
 		with database.DBRequest() as db:
 			removalRequests = archive.fetch_removal_requests(db, cleared=False)
-		return flask.render_template('pages/admin/dashboard.html', removalRequests=removalRequests)
+			partitions = database.get_partition_stats(db)
+		return flask.render_template(
+			'pages/admin/dashboard.html',
+			removalRequests=removalRequests,
+			queryStats=database.get_query_stats(),
+			translationStats=database.get_translation_stats(),
+			poolStats=database.get_pool_stats(),
+			writerStats=database.get_writer_stats(),
+			httpStats=scoredapi.get_http_stats(),
+			coalesceStats=scoredapi.get_coalesce_stats(),
+			pacerStats=scoredapi.get_pacer().get_stats(),
+			respCacheStats=scoredapi.get_resp_cache().get_stats(),
+			diskCacheStats=scoredapi.get_disk_cache().get_stats() if scoredapi.get_disk_cache() else None,
+			partitions=partitions,
+			updateStats=archive.get_update_stats(),
+			compressionStats=archive.get_compression_stats() if st.config['compress_content'] else None,
+			slowQueryMs=st.config['slow_query_ms']
+		)
 	else:
 		return flask.render_template('pages/admin/login.html')
 
@@ -112,6 +129,7 @@ def ajax_get_profile():
 	username = flask.request.args.get('user', '')
 	contentType = flask.request.args.get('type', 'comment')
 	page = helpers.safeint(flask.request.args.get('page'), 1)
+	before = helpers.safeint(flask.request.args.get('before'), 0)
 	from_post = helpers.safeint(flask.request.args.get('from_post'), 0)
 	from_comment = helpers.safeint(flask.request.args.get('from_comment'), 0)
 	with database.DBRequest() as db:
@@ -119,9 +137,9 @@ def ajax_get_profile():
 			if contentType == 'removed':
 				return flask.jsonify(datafetch.fetch_profile_removedcontent(db, username, from_post, from_comment))
 			if contentType == 'post':
-				return flask.jsonify(datafetch.fetch_profile_posts(db, username, page))
+				return flask.jsonify(datafetch.fetch_profile_posts(db, username, page, before))
 			else:
-				return flask.jsonify(datafetch.fetch_profile_comments(db, username, page))
+				return flask.jsonify(datafetch.fetch_profile_comments(db, username, page, before))
 		except datafetch.RequestFailed as e:
 			return flask.jsonify({
 				'error': str(e)
@@ -183,9 +201,10 @@ def ajax_get_logs():
 	action = flask.request.args.get('action', '*')
 	moderator = flask.request.args.get('moderator', '*')
 	target = flask.request.args.get('target', '*')
+	before = helpers.safeint(flask.request.args.get('before'), 0)
 	with database.DBRequest() as db:
 		try:
-			return flask.jsonify(datafetch.fetch_modlogs(db, community, page, action, moderator, target))
+			return flask.jsonify(datafetch.fetch_modlogs(db, community, page, action, moderator, target, before))
 		except datafetch.RequestFailed as e:
 			return flask.jsonify({
 				'error': str(e)
@@ -264,6 +283,11 @@ def ajax_unblock_ip():
 	st.unblock_ip(ip)
 	return flask.jsonify({'status': True})
 
+@wapp.route('POST', '/ajax/reset-query-stats', is_admin=True)
+def ajax_reset_query_stats():
+	database.reset_query_stats()
+	return flask.jsonify({'status': True})
+
 
 @wapp.route('POST', '/ajax/db-query', is_admin=True)
 def ajax_db_query():
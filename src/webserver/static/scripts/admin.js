@@ -22,6 +22,12 @@ function submitUnblockIPForm(event) {
 	});
 }
 
+function resetQueryStats() {
+	ajaxRequest('POST', '/ajax/reset-query-stats', {}, function (response, code) {
+		window.location.reload();
+	});
+}
+
 
 function sendDbQuery() {
 	var query = document.getElementById('db-query').value;
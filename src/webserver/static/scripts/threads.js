@@ -924,7 +924,7 @@ function profileLoadMore(user, from_post, from_comment) {
 	});
 }
 
-function renderProfile(urlinfo, content, has_more_entries) {
+function renderProfile(urlinfo, content, has_more_entries, next_before) {
 	console.log(urlinfo)
 	document.getElementById('profile-content').innerHTML = '';
 	document.getElementById('loading-text').innerText = 'Rendering profile...';
@@ -945,7 +945,7 @@ function renderProfile(urlinfo, content, has_more_entries) {
 	}
 	if (has_more_entries) {
 		document.getElementById('btn-nextpage').style = '';
-		document.getElementById('btn-nextpage').href = '?type=' + urlinfo.content + '&page=' + (urlinfo.page + 1);
+		document.getElementById('btn-nextpage').href = '?type=' + urlinfo.content + '&page=' + (urlinfo.page + 1) + (next_before ? '&before=' + next_before : '');
 	} else {
 		document.getElementById('btn-nextpage').style = 'display: none;';
 	}
@@ -964,7 +964,8 @@ function onLoadFetchProfile(urlinfo) {
 		ajaxRequest('GET', '/ajax/profile.json', {
 			'user': urlinfo.user,
 			'type': urlinfo.content,
-			'page': urlinfo.page
+			'page': urlinfo.page,
+			'before': urlinfo.before
 		}, function (response, code) {
 			console.log(response)
 			if ('error' in response) {
@@ -974,7 +975,8 @@ function onLoadFetchProfile(urlinfo) {
 					renderProfile(
 						urlinfo,
 						urlinfo.content == 'post' ? response.posts : response.comments,
-						response.has_more_entries
+						response.has_more_entries,
+						response.next_before
 					);
 				}, 200);
 			}
@@ -1206,7 +1208,7 @@ function renderModlogRecord(community, data) {
 	return record;
 }
 
-function renderModlog(urlinfo, content, moderators, has_more_entries) {
+function renderModlog(urlinfo, content, moderators, has_more_entries, next_before) {
 	console.log(urlinfo)
 
 	var modfilter = document.getElementById('filter-moderator');
@@ -1262,7 +1264,7 @@ function renderModlog(urlinfo, content, moderators, has_more_entries) {
 	}
 	if (has_more_entries) {
 		document.getElementById('btn-nextpage').style = '';
-		document.getElementById('btn-nextpage').href = '?type=' + urlinfo.action + '&moderator=' + urlinfo.moderator + '&target=' + urlinfo.target + '&page=' + (urlinfo.page + 1);
+		document.getElementById('btn-nextpage').href = '?type=' + urlinfo.action + '&moderator=' + urlinfo.moderator + '&target=' + urlinfo.target + '&page=' + (urlinfo.page + 1) + (next_before ? '&before=' + next_before : '');
 	} else {
 		document.getElementById('btn-nextpage').style = 'display: none;';
 	}
@@ -1277,6 +1279,7 @@ function onLoadFetchModlog(urlinfo) {
 	ajaxRequest('GET', '/ajax/logs.json', {
 		'community': urlinfo.community,
 		'page': urlinfo.page,
+		'before': urlinfo.before,
 		'action': urlinfo.action,
 		'moderator': urlinfo.moderator,
 		'target': urlinfo.target
@@ -1286,7 +1289,7 @@ function onLoadFetchModlog(urlinfo) {
 			dispError(response.error);
 		} else {
 			setTimeout(function () {
-				renderModlog(urlinfo, response.records, response.moderators, response.has_more_entries);
+				renderModlog(urlinfo, response.records, response.moderators, response.has_more_entries, response.next_before);
 			}, 200);
 		}
 	});